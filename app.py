@@ -1,13 +1,20 @@
+import os
+import queue
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 from tkinter import N, W, E, S, HORIZONTAL, BOTH, LEFT, END, NORMAL, DISABLED
 
 from PIL import Image, ImageTk
 
 from stegan import Steganography
-from stegan.psnr import psnr
+from stegan.capacity import capacity, plan
+from stegan.steganography import SteganographyException
 
 class App(tk.Frame):
+    UPDATE_DELAY_MS = 300
+    POLL_INTERVAL_MS = 50
+
     def __init__(self, master=None):
         super().__init__(master)
         self.master = master
@@ -35,7 +42,19 @@ class App(tk.Frame):
         self.processed_image = None
         self.current_imagetk = None
 
+        # encode, decode and psnr run on a single worker thread, results come
+        # back through job_results and are applied on the tk thread
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.job_results = queue.Queue()
+        self.job_id = 0
+        self.job = None
+        self.pending_update = None
+        self.cover = None
+        self.cover_key = None
+        self.status = tk.StringVar(value="Ready")
+
         self.create_widgets()
+        self.poll_results()
     
     def create_widgets(self):
         # Button for selecting source image
@@ -90,9 +109,12 @@ class App(tk.Frame):
             self, text="Decode", variable=self.mode, value="decode"
         ).grid(row=7, column=1, sticky=W)
 
+        # Background job status
+        tk.Label(self, textvariable=self.status).grid(row=8, column=0, sticky=W)
+
         # Save button
         self.save_button = tk.Button(self, text="Save", command=self.save_file)
-        self.save_button.grid(row=8, column=0, columnspan=2, sticky=E)
+        self.save_button.grid(row=8, column=1, sticky=E)
 
     def select_file(self):
         filename = askopenfilename(filetypes=[("Image","*.png"), ("Image","*.bmp")])
@@ -113,38 +135,104 @@ class App(tk.Frame):
             return
 
         img_w, img_h = self.original_image.size
-        avl_bit = img_w * img_h * self.bitlen.get()
-        avl_byte = avl_bit // 8
+        bitlen = self.bitlen.get()
+        msg_filename = self.msg_filename.get()
 
         message = self.message.get()
         message_bytes = message.encode("utf-8")
         msg_len = len(message)
         msg_byte = len(message_bytes)
-        byte_left = avl_byte - msg_byte
+
+        try:
+            avl_byte = capacity(self.original_image, bitlen)
+            fit = plan(self.original_image, msg_byte, msg_filename)
+        except SteganographyException as e:
+            self.stats_label["text"] = f"size={img_w}x{img_h} {e}"
+            return
+        # the 8 byte header and the filename are stored with the message
+        byte_left = avl_byte - 8 - len(msg_filename.encode("latin-1", "replace")) - msg_byte
 
         password = self.password.get()
         enc = "encrypted" if password != "" else "not encrypted"
 
-        result_text = f"size={img_w}x{img_h} {avl_bit=}bits {avl_byte=}bytes"
+        result_text = f"size={img_w}x{img_h} {avl_byte=}bytes"
         result_text += f"\n{msg_len=} {msg_byte=} {byte_left=}bytes"
+        if fit is None:
+            result_text += "\ndoes not fit at any bit count"
+        else:
+            result_text += f"\nmin bits={fit.lsb} pixels={fit.pixels} psnr>={fit.psnr_min:.2f} (about {fit.psnr_expected:.2f})"
         result_text += f"\n{password=} {enc}"
 
         self.stats_label["text"] = result_text
     
     def update_image_shown(self):
+        # debounced, only the last change within UPDATE_DELAY_MS starts a job
+        if self.pending_update is not None:
+            self.after_cancel(self.pending_update)
+        self.pending_update = self.after(self.UPDATE_DELAY_MS, self.start_update)
+
+    def start_update(self):
+        self.pending_update = None
+        self.job_id += 1
+
+        # a job still waiting in the queue is superseded by this one
+        if self.job is not None:
+            self.job.cancel()
+
         mode = self.mode.get()
-        print(f"update img shown {mode=}")
-        if mode == "encode":
-            new_image = self.encode_image() or self.original_image
-            self.processed_image = new_image
-            print(f"update_image {self.original_image=} {self.processed_image=}")
-            if self.processed_image == self.original_image:
+        params = {
+            "mode": mode,
+            "is_file_set": self.is_file_set(),
+            "src_filename": self.src_filename.get(),
+            "msg_filename": self.msg_filename.get(),
+            "message": self.message.get().encode(),
+            "password": self.password.get(),
+            "bitlen": self.bitlen.get(),
+        }
+        print(f"update img shown {mode=} job={self.job_id}")
+
+        self.status.set("Encoding..." if mode == "encode" else "Decoding...")
+        self.job = self.worker.submit(self.run_update, self.job_id, params)
+
+    # runs on the worker thread, must not touch any widget or tk variable
+    def run_update(self, job_id, params):
+        try:
+            if params["mode"] == "encode":
+                result = self.encode_image(params)
+                # skip psnr when a newer job is already waiting
+                if result is not None and job_id == self.job_id:
+                    image, changes = result
+                    result = image, changes.psnr()
+                self.job_results.put((job_id, "encode", result))
+            else:
+                self.job_results.put((job_id, "decode", self.decode_image(params)))
+        except Exception as e:
+            self.job_results.put((job_id, "error", e))
+
+    def poll_results(self):
+        while not self.job_results.empty():
+            job_id, kind, result = self.job_results.get()
+            # results of superseded jobs are dropped
+            if job_id == self.job_id:
+                self.show_update_result(kind, result)
+        self.after(self.POLL_INTERVAL_MS, self.poll_results)
+
+    def show_update_result(self, kind, result):
+        self.status.set("Ready")
+
+        if kind == "error":
+            print(f"update failed {result=}")
+            self.status.set(f"Error: {result}")
+        elif kind == "encode":
+            if result is None:
+                self.processed_image = self.original_image
                 self.psnr.set(f"Image is same")
             else:
-                psnr_res = psnr(self.original_image, self.processed_image)
+                self.processed_image, psnr_res = result
                 self.psnr.set(f"{psnr_res}")
+            print(f"update_image {self.original_image=} {self.processed_image=}")
         else:
-            message = self.decode_image()
+            message = result
             print(f"decode {message=}")
             if message is not None:
                 self.message.set(message.decode())
@@ -154,30 +242,42 @@ class App(tk.Frame):
                 self.message.set("")
                 self.msg_filename.set("NO MESSAGE FOUND")
                 self.save_button["state"] = DISABLED
-    
-    def encode_image(self):
-        if not self.is_file_set(): return
 
-        src_filename = self.src_filename.get()
-        msg_filename = self.msg_filename.get()
-        message = self.message.get().encode()
-        password = self.password.get()
-        bitlen = self.bitlen.get()
-        
-        s = Steganography(src_filename)
-        s.set_stego_payload(msg_filename, message, password, bitlen)
+    # the decoded cover is kept between jobs, only used on the worker thread.
+    # It is keyed by the file's mtime and size too, so a file saved over or
+    # changed on disk is decoded again.
+    def get_cover(self, src_filename):
+        stat = os.stat(src_filename)
+        cover_key = (src_filename, stat.st_mtime_ns, stat.st_size)
+        if self.cover is None or self.cover_key != cover_key:
+            self.cover = Steganography(src_filename)
+            self.cover_key = cover_key
+        return self.cover
+
+    def encode_image(self, params):
+        if not params["is_file_set"]: return
+
+        src_filename = params["src_filename"]
+        msg_filename = params["msg_filename"]
+        message = params["message"]
+        password = params["password"]
+        bitlen = params["bitlen"]
+
+        s = self.get_cover(src_filename)
+        changes = s.set_stego_payload(msg_filename, message, password, bitlen, track_changes=True)
 
         print(f"encoding {src_filename=} {msg_filename=} {password=} {bitlen=}")
 
         result = s.get_stego_image()
-        return result
-    
-    def decode_image(self):
-        src_filename = self.src_filename.get()
-        password = self.password.get()
-        bitlen = self.bitlen.get()
+        return result, changes
+
+    def decode_image(self, params):
+        src_filename = params["src_filename"]
+        password = params["password"]
+        bitlen = params["bitlen"]
+        if src_filename == "": return
 
-        s = Steganography(src_filename)
+        s = self.get_cover(src_filename)
         print(f"decode {password=} {bitlen=}")
 
         msg_filename, result = s.get_stego_payload(password, bitlen)
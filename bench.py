@@ -0,0 +1,209 @@
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import product
+
+import numpy as np
+from PIL import Image
+
+from stegan import Permutation, Steganography
+from stegan.psnr import psnr
+
+MODES = ["L", "P", "RGB", "RGBA"]
+SIZES = [256, 512, 1024, 2048]
+FULL_SIZES = [256, 512, 1024, 2048, 4096, 8192]
+LSBS = [1, 2, 3, 4]
+FILLS = [0.01, 0.1, 0.5, 1.0]
+
+KEY = "benchmark key"
+FILENAME = "payload.bin"
+
+
+def make_cover(mode: str, size: int) -> bytes:
+    rng = np.random.default_rng(size)
+    channels = {"L": 1, "P": 1, "RGB": 3, "RGBA": 4}[mode]
+    data = rng.integers(0, 256, size=(size, size, channels), dtype=np.uint8)
+
+    img = Image.frombytes(mode, (size, size), data.tobytes())
+    if mode == "P":
+        img.putpalette(rng.integers(0, 256, size=768, dtype=np.uint8).tobytes())
+
+    f = io.BytesIO()
+    img.save(f, "PNG", compress_level=1)
+    return f.getvalue()
+
+
+class Timer:
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        yield
+        self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - started
+
+
+# Drives the public API on instrumented Steganography instances. Phases
+# inside embed, rebuild and extract come from their reports, named
+# operation.phase, the rest is timed here.
+def run_case(cover: bytes, lsb: int, fill: float, layout: int) -> dict:
+    timer = Timer()
+    started = time.perf_counter()
+
+    with timer.phase("load"):
+        s = Steganography(io.BytesIO(cover))
+
+    payload_size = max(0, int((s.get_payload_size(lsb) - 8 - len(FILENAME)) * fill))
+    payload = np.random.default_rng(payload_size).integers(0, 256, payload_size, dtype=np.uint8).tobytes()
+
+    with s.instrumented() as reports:
+        s.set_stego_payload(FILENAME, payload, KEY, lsb, layout=layout)
+        stego = s.get_stego_image()
+
+    with timer.phase("save"):
+        f = io.BytesIO()
+        stego.save(f, "PNG", compress_level=1)
+
+    extractor = Steganography(io.BytesIO(f.getvalue()))
+    with extractor.instrumented() as extract_reports:
+        extracted = extractor.get_stego_payload(KEY, lsb, layout=layout)
+
+    with timer.phase("psnr"):
+        psnr(s.get_base_image(), stego)
+
+    if extracted != (FILENAME.encode("latin-1"), payload):
+        raise RuntimeError("Round trip mismatch")
+
+    phases = timer.phases
+    for report in reports + extract_reports:
+        if not report.phases:
+            phases[report.name] = report.seconds
+        for name, stats in report.phases.items():
+            phases[f"{report.name}.{name}"] = stats.seconds
+
+    return {"payload_bytes": payload_size, "phases": phases, "total": time.perf_counter() - started}
+
+
+# Peak resident memory of one case run in a fresh process, so the buffers
+# PIL allocates in C are counted too
+def _case_peak_rss(cover: bytes, lsb: int, fill: float, layout: int) -> int:
+    import resource
+
+    run_case(cover, lsb, fill, layout)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def peak_rss(cover: bytes, lsb: int, fill: float, layout: int) -> int:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_case_peak_rss, cover, lsb, fill, layout).result()
+
+
+def case_id(case: dict) -> str:
+    return f"{case['mode']}-{case['size']}-lsb{case['lsb']}-fill{case['fill']}-{case['layout']}"
+
+
+def run(args) -> list:
+    results = []
+    for mode, size in product(args.modes, args.sizes):
+        cover = make_cover(mode, size)
+
+        for lsb, fill, layout in product(args.lsb, args.fill, args.layouts):
+            case = {"mode": mode, "size": size, "lsb": lsb, "fill": fill, "layout": layout}
+
+            best = None
+            for _ in range(args.repeat):
+                result = run_case(cover, lsb, fill, Permutation.NAMES[layout])
+                if best is None or result["total"] < best["total"]:
+                    best = result
+
+            if args.memory:
+                best["peak_rss_bytes"] = peak_rss(cover, lsb, fill, Permutation.NAMES[layout])
+
+            best.update(case, id=case_id(case))
+            results.append(best)
+            print(f"{best['id']}: {best['total']:.4f}s", file=sys.stderr, flush=True)
+
+    return results
+
+
+# A phase regresses when it is slower than the baseline by more than the
+# tolerance and by more than min_seconds, so timer noise on tiny phases is
+# not reported
+def compare(results: list, baseline: list, tolerance: float, min_seconds: float) -> list:
+    previous = {result["id"]: result for result in baseline}
+    regressions = []
+
+    for result in results:
+        old = previous.get(result["id"])
+        if old is None:
+            continue
+
+        for name, seconds in result["phases"].items():
+            old_seconds = old["phases"].get(name)
+            if old_seconds is None:
+                continue
+            if seconds > old_seconds * (1 + tolerance) and seconds - old_seconds > min_seconds:
+                regressions.append({"id": result["id"], "phase": name, "baseline": old_seconds, "current": seconds})
+
+        if "peak_rss_bytes" in result and "peak_rss_bytes" in old:
+            if result["peak_rss_bytes"] > old["peak_rss_bytes"] * (1 + tolerance):
+                regressions.append({
+                    "id": result["id"], "phase": "peak_rss_bytes",
+                    "baseline": old["peak_rss_bytes"], "current": result["peak_rss_bytes"]
+                })
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark embed, extract, cipher and metrics")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--sizes", nargs="+", type=int, default=None, help="cover edge lengths in pixels")
+    parser.add_argument("--full", action="store_true", help="sweep sizes up to 8192x8192")
+    parser.add_argument("--lsb", nargs="+", type=int, default=LSBS)
+    parser.add_argument("--fill", nargs="+", type=float, default=FILLS, help="payload size as a fraction of capacity")
+    parser.add_argument("--layouts", nargs="+", default=["legacy"], choices=list(Permutation.NAMES))
+    parser.add_argument("--repeat", type=int, default=3, help="keep the fastest of this many runs")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the peak memory run in a separate process")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 is 25%%")
+    parser.add_argument("--min-seconds", type=float, default=0.005)
+    args = parser.parse_args(argv)
+
+    if args.sizes is None:
+        args.sizes = FULL_SIZES if args.full else SIZES
+
+    results = run(args)
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print(json.dumps(regression))
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
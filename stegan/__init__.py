@@ -1 +1,2 @@
+from .permutation import Permutation
 from .steganography import Steganography
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from . import psnr as _psnr
+from .permutation import Permutation
+from .steganography import Steganography
+
+# asyncio front end to embed, extract and psnr. Images are decoded and
+# encoded on a thread pool, the embedding, extraction and comparison run on
+# a process pool, so the event loop is never blocked.
+#
+# At most limit operations run at once, further callers wait for a slot,
+# which holds back producers that submit faster than the pools keep up.
+# Cancelling a caller drops the stages not started yet. A stage already
+# running cannot be interrupted, so the caller gets CancelledError once it
+# ends and keeps its slot until then: cancelled work never piles up on the
+# pools, and nothing is written after the cancellation went through.
+
+
+def _decode(image) -> Image:
+    if isinstance(image, Image.Image):
+        return image
+    img = Image.open(image)
+    img.load()
+    return img
+
+
+def _embed(image: Image, filename: str, payload: bytes, key: str, lsb: int, layout: int,
+           compression: int) -> Image:
+    s = Steganography(image)
+    s.set_stego_payload(filename, payload, key, lsb, layout=layout, compression=compression)
+    return s.get_stego_image()
+
+
+def _extract(image: Image, key: str, lsb: int, layout: int):
+    return Steganography(image).get_stego_payload(key, lsb, layout)
+
+
+class AsyncSteganography:
+    # executor runs the CPU bound stages, a process pool of processes
+    # workers by default. io_executor decodes and encodes images, a thread
+    # pool by default. Executors passed in are not shut down by close.
+    def __init__(self, limit: int = None, processes: int = None, executor=None, io_executor=None):
+        self._limit = limit or os.cpu_count()
+        self._own = []
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=processes)
+            self._own.append(executor)
+        if io_executor is None:
+            io_executor = ThreadPoolExecutor(max_workers=self._limit)
+            self._own.append(io_executor)
+        self._executor = executor
+        self._io_executor = io_executor
+        # a semaphore belongs to the loop it is first used on
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _slot(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self._limit)
+        return self._semaphores[loop]
+
+    @staticmethod
+    async def _run(executor, fn, *args):
+        future = executor.submit(fn, *args)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not future.cancel():
+                await asyncio.wait([asyncio.wrap_future(future)])
+            raise
+
+    # The stego image, also saved to output when given
+    async def embed(self, cover, filename: str, payload: bytes, key: str, lsb: int,
+                    layout: int = Permutation.LEGACY, compression: int = None, output=None) -> Image:
+        async with self._slot():
+            image = await self._run(self._io_executor, _decode, cover)
+            stego = await self._run(self._executor, _embed, image, filename, payload, key, lsb, layout,
+                                    compression)
+            if output is not None:
+                await self._run(self._io_executor, stego.save, output)
+            return stego
+
+    # (filename, content), (None, None) when the image holds no payload
+    async def extract(self, image, key: str, lsb: int, layout: int = Permutation.LEGACY):
+        async with self._slot():
+            image = await self._run(self._io_executor, _decode, image)
+            return await self._run(self._executor, _extract, image, key, lsb, layout)
+
+    async def psnr(self, image1, image2, alpha: bool = False) -> float:
+        async with self._slot():
+            image1, image2 = await asyncio.gather(
+                self._run(self._io_executor, _decode, image1),
+                self._run(self._io_executor, _decode, image2)
+            )
+            return await self._run(self._executor, _psnr.psnr, image1, image2, alpha)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        for executor in self._own:
+            await loop.run_in_executor(None, executor.shutdown)
+        self._own.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+_default = None
+
+
+def _instance() -> AsyncSteganography:
+    global _default
+    if _default is None:
+        _default = AsyncSteganography()
+    return _default
+
+
+# Module level shortcuts on a shared AsyncSteganography with the defaults
+async def embed(cover, filename: str, payload: bytes, key: str, lsb: int, layout: int = Permutation.LEGACY,
+                compression: int = None, output=None) -> Image:
+    return await _instance().embed(cover, filename, payload, key, lsb, layout, compression, output)
+
+
+async def extract(image, key: str, lsb: int, layout: int = Permutation.LEGACY):
+    return await _instance().extract(image, key, lsb, layout)
+
+
+async def psnr(image1, image2, alpha: bool = False) -> float:
+    return await _instance().psnr(image1, image2, alpha)
@@ -0,0 +1,115 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import isinf
+
+from .compression import Compression
+from .permutation import Permutation
+from .steganography import Steganography
+
+# Manifest columns, as CSV with a header row or as one JSON object per line
+# cover: cover image path
+# payload: file to hide, its base name is stored as the payload filename
+# key: password, optional
+# lsb: bits per channel, optional, defaults to 1
+# output: stego image path
+# layout: pixel order name, optional, defaults to legacy
+# compression: none, zlib, lzma, bz2 or auto, optional, defaults to the
+#   original uncompressed format
+
+
+def read_manifest(filename: str):
+    with open(filename, newline="") as f:
+        if filename.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def run_job(index: int, job: dict, verify: bool) -> dict:
+    result = {"index": index, "cover": job.get("cover"), "output": job.get("output")}
+    started = time.perf_counter()
+
+    try:
+        key = job.get("key") or ""
+        # an empty CSV cell counts as missing, 0 is left for _check_lsb to reject
+        lsb = int(job["lsb"]) if job.get("lsb") not in (None, "") else 1
+        layout = Permutation.NAMES[job.get("layout") or "legacy"]
+        compression = Compression.NAMES[job["compression"]] if job.get("compression") else None
+
+        with open(job["payload"], "rb") as f:
+            payload = f.read()
+        filename = os.path.basename(job["payload"])
+
+        s = Steganography(job["cover"])
+        changes = s.set_stego_payload(filename, payload, key, lsb, layout=layout, track_changes=True,
+                                      compression=compression)
+        s.get_stego_image().save(job["output"])
+        result["embed_seconds"] = time.perf_counter() - started
+
+        psnr_res = changes.psnr()
+        result["psnr"] = None if isinf(psnr_res) else psnr_res
+        result["payload_bytes"] = len(payload)
+
+        if verify:
+            verify_started = time.perf_counter()
+            extracted = Steganography(job["output"]).get_stego_payload(key, lsb, layout=layout)
+            result["verified"] = extracted == (filename.encode("latin-1"), payload)
+            result["verify_seconds"] = time.perf_counter() - verify_started
+
+        result["ok"] = not verify or result["verified"]
+    # any failure, bad manifest values included, only fails this job
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def run_batch(manifest, workers: int = None, verify: bool = False):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_job, index, job, verify): (index, job)
+            for index, job in enumerate(manifest)
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # the worker itself failed, a crash or a job it could not unpickle
+                index, job = futures[future]
+                yield {
+                    "index": index,
+                    "cover": job.get("cover") if isinstance(job, dict) else None,
+                    "output": job.get("output") if isinstance(job, dict) else None,
+                    "ok": False,
+                    "error": f"{type(e).__name__}: {e}",
+                }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m stegan.batch",
+        description="Embed payloads into covers listed in a manifest, one JSON result per line")
+    parser.add_argument("manifest", help="CSV file with a header row, or JSON lines")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--verify", action="store_true", help="extract each output again and compare")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for result in run_batch(read_manifest(args.manifest), args.workers, args.verify):
+        failed += not result["ok"]
+        print(json.dumps(result), flush=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import io
+import mmap
+import shutil
+from struct import unpack_from
+
+import numpy as np
+from PIL import Image
+
+from .instrument import NULL_REPORT
+from .permutation import Permutation
+from .steganography import Steganography, SteganographyException
+
+
+# Channel values of an uncompressed BMP pixel array inside a buffer,
+# addressed like the flat pixel array of a decoded image: rows top to
+# bottom, channels in RGB order. Rows in the file are padded to 4 bytes,
+# usually stored bottom up, and their channels are in BGR order.
+class _MappedValues:
+    def __init__(self, data: np.ndarray, offset: int, width: int, height: int,
+                 stride: int, pixel_bytes: int, channel_offsets: list, bottom_up: bool):
+        self._data = data
+        self._width = width
+        self._pixel_bytes = pixel_bytes
+        self._channel_offsets = np.array(channel_offsets, dtype=np.int64)
+        self.size = width * height * len(channel_offsets)
+
+        if bottom_up:
+            self._first_row = offset + (height - 1) * stride
+            self._row_step = -stride
+        else:
+            self._first_row = offset
+            self._row_step = stride
+
+    def _offsets(self, positions) -> np.ndarray:
+        pixel, channel = np.divmod(np.asarray(positions, dtype=np.int64), len(self._channel_offsets))
+        y, x = np.divmod(pixel, self._width)
+        return self._first_row + y * self._row_step + x * self._pixel_bytes + self._channel_offsets[channel]
+
+    def __getitem__(self, positions) -> np.ndarray:
+        return self._data[self._offsets(positions)]
+
+    def __setitem__(self, positions, values):
+        self._data[self._offsets(positions)] = values
+
+
+# Embeds into and extracts from an uncompressed 8, 24 or 32 bit BMP
+# through a memory map of the file, without decoding it. Only the bytes
+# of the payload symbols are touched.
+#
+# By default the map is private, nothing is written to disk until save.
+# With output the cover is copied there and the copy is changed, with
+# in_place the cover file itself is changed.
+#
+# Unlike Steganography, which keeps the cover apart from the stego pixels,
+# there is only the map: get_stego_payload reads the stego bytes once a
+# payload is embedded. Embedding again first puts back the bytes the last
+# embed changed, so the result is the same as embedding into the cover.
+class BmpSteganography(Steganography):
+    # bits per pixel: channel byte offsets within a pixel, in RGB order
+    _CHANNELS = {8: [0], 24: [2, 1, 0], 32: [2, 1, 0]}
+
+    def __init__(self, filename: str, output: str = None, in_place: bool = False):
+        if output is not None and in_place:
+            raise SteganographyException("Use either output or in_place")
+        super().__init__(filename)
+
+        if output is not None:
+            shutil.copyfile(filename, output)
+            self._path, access = output, mmap.ACCESS_WRITE
+        elif in_place:
+            self._path, access = filename, mmap.ACCESS_WRITE
+        else:
+            self._path, access = filename, mmap.ACCESS_COPY
+
+        self._access = access
+        # (positions, old values) of the bytes the last embed changed
+        self._previous = None
+        with open(self._path, "r+b" if access == mmap.ACCESS_WRITE else "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=access)
+        self._mapped = self._parse(np.frombuffer(self._map, dtype=np.uint8))
+
+    def _parse(self, data: np.ndarray) -> _MappedValues:
+        if len(self._map) < 26 or self._map[:2] != b"BM":
+            raise SteganographyException("Not a BMP file")
+
+        offset, = unpack_from("<I", self._map, 10)
+        header_size, = unpack_from("<I", self._map, 14)
+        if header_size == 12:
+            width, height, _, bits = unpack_from("<HHHH", self._map, 18)
+            compression = 0
+        else:
+            width, height, _, bits, compression = unpack_from("<iiHHI", self._map, 18)
+
+        if compression != 0 or bits not in self._CHANNELS:
+            raise SteganographyException("Only uncompressed 8, 24 and 32 bit BMP are supported")
+        if (width, abs(height)) != self._base_image.size:
+            raise SteganographyException("Unexpected BMP header")
+
+        channels = self._CHANNELS[bits]
+        if len(channels) != self._get_channels():
+            raise SteganographyException("Unexpected BMP pixel format")
+
+        stride = (width * bits + 31) // 32 * 4
+        if offset + stride * abs(height) > len(self._map):
+            raise SteganographyException("Truncated BMP file")
+
+        return _MappedValues(data, offset, width, abs(height), stride, bits // 8, channels, height > 0)
+
+    def _embed(self, header: bytes, payload: bytes, key: str, lsb: int,
+               layout: int = Permutation.LEGACY, track_changes: bool = False):
+        changes = super()._embed(header, payload, key, lsb, layout, True)
+        self._previous = changes.positions, changes.old
+        if track_changes:
+            return changes
+
+    def _embed_target(self, report=NULL_REPORT):
+        if self._previous is not None:
+            positions, old = self._previous
+            self._mapped[positions] = old
+            self._previous = None
+        self._payloaded_pixel = self._mapped
+        return self._mapped
+
+    def _values(self, report=NULL_REPORT, needed: int = None):
+        return self._mapped
+
+    def get_stego_image(self) -> Image:
+        if self._payloaded_pixel is None:
+            return None
+        return Image.open(io.BytesIO(self._map))
+
+    def flush(self):
+        if self._access == mmap.ACCESS_WRITE and not self._map.closed:
+            self._map.flush()
+
+    # writes the changed file, the only way to keep a private map
+    def save(self, filename: str):
+        with open(filename, "wb") as f:
+            f.write(self._map)
+
+    def close(self):
+        self._mapped = None
+        self._payloaded_pixel = None
+        self._previous = None
+        if not self._map.closed:
+            self.flush()
+            self._map.close()
+        super().close()
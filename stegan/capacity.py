@@ -0,0 +1,104 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+from .engine import symbol_count
+from .psnr import psnr_from_mse
+from .steganography import Steganography
+
+# What embedding a payload at the smallest lsb that fits would do to a
+# cover. psnr_min assumes every touched value moves as far as lsb allows,
+# psnr_expected assumes random cover and payload bits, psnr_max is when
+# the payload bits already match the cover.
+CapacityPlan = namedtuple(
+    "CapacityPlan",
+    ["lsb", "capacity", "payload_bytes", "symbols", "pixels", "psnr_min", "psnr_expected", "psnr_max"]
+)
+
+
+# Covers are only opened, never decoded: mode, size and palette come from
+# the image header
+@contextmanager
+def _cover(image):
+    if isinstance(image, Steganography):
+        yield image
+    elif isinstance(image, Image.Image):
+        yield Steganography(image)
+    else:
+        with Image.open(image) as img:
+            yield Steganography(img)
+
+
+def capacity(image, lsb: int) -> int:
+    with _cover(image) as s:
+        return s.get_payload_size(lsb)
+
+
+# RGB palette of a palette image. getpalette() would decode the whole
+# image, so the palette as read from the file, in whatever raw mode it is
+# stored (BGRX in BMP), is unpacked on a 1x1 image instead.
+def _palette_colors(img: Image) -> list:
+    if img.palette is None:
+        return img.getpalette()
+
+    strip = Image.new("P", (1, 1))
+    strip.putpalette(img.palette.palette, img.palette.rawmode or img.palette.mode)
+    return strip.getpalette("RGB")
+
+
+# Squared error of one touched value, worst case and on average. Palette
+# indices change within groups of 2**lsb entries, the error is the color
+# distance between them.
+def _value_errors(img: Image, lsb: int):
+    m = 1 << lsb
+    if img.mode != "P":
+        return (m - 1) ** 2, (m * m - 1) / 6
+
+    colors = _palette_colors(img)[:768]
+    palette = np.zeros(768)
+    palette[:len(colors)] = colors
+    groups = palette.reshape(256 // m, m, 3)
+    diff = groups[:, :, None, :] - groups[:, None, :, :]
+    distances = np.einsum("gijc,gijc->gij", diff, diff)
+    return distances.max(), distances.mean()
+
+
+def _plan(s: Steganography, lsb: int, payload_bytes: int) -> CapacityPlan:
+    img = s.get_base_image()
+    channels = s._get_channels()
+    symbols = symbol_count(payload_bytes, lsb)
+
+    # psnr leaves out alpha and compares palette images by their RGB color
+    if img.mode == "P":
+        bands, counted = 3, symbols
+    elif "A" in img.getbands():
+        bands, counted = channels - 1, symbols - symbols // channels
+    else:
+        bands, counted = channels, symbols
+
+    worst, expected = _value_errors(img, lsb)
+    values = img.width * img.height * bands
+    return CapacityPlan(
+        lsb=lsb,
+        capacity=s.get_payload_size(lsb),
+        payload_bytes=payload_bytes,
+        symbols=symbols,
+        pixels=-(-symbols // channels),
+        psnr_min=psnr_from_mse(counted * worst / values),
+        psnr_expected=psnr_from_mse(counted * expected / values),
+        psnr_max=psnr_from_mse(0)
+    )
+
+
+# Plan for a payload of payload_size bytes stored as filename, at the given
+# lsb or the smallest one it fits in. None when it does not fit.
+def plan(image, payload_size: int, filename: str = "", lsb: int = None) -> CapacityPlan:
+    payload_bytes = 8 + len(filename.encode("latin-1", "replace")) + payload_size
+
+    with _cover(image) as s:
+        for lsb in [lsb] if lsb is not None else range(1, 5):
+            if payload_bytes <= s.get_payload_size(lsb):
+                return _plan(s, lsb, payload_bytes)
+    return None
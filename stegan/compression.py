@@ -0,0 +1,46 @@
+import bz2
+import lzma
+import zlib
+
+
+class CompressionException(Exception):
+    pass
+
+
+# Stored as a flag in the versioned payload header. AUTO is never stored,
+# it picks whichever method gives the smallest result, or NONE when none
+# of them makes the payload smaller.
+class Compression:
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+    BZ2 = 3
+    AUTO = 255
+    NAMES = {"none": NONE, "zlib": ZLIB, "lzma": LZMA, "bz2": BZ2, "auto": AUTO}
+
+    _MODULES = {ZLIB: zlib, LZMA: lzma, BZ2: bz2}
+    _ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError)
+
+    # (method used, data)
+    @staticmethod
+    def compress(data: bytes, method: int):
+        if method == Compression.NONE:
+            return method, data
+        if method == Compression.AUTO:
+            candidates = [Compression.compress(data, m) for m in Compression._MODULES]
+            best = min(candidates, key=lambda candidate: len(candidate[1]))
+            return best if len(best[1]) < len(data) else (Compression.NONE, data)
+        if method not in Compression._MODULES:
+            raise CompressionException("Invalid compression method")
+        return method, Compression._MODULES[method].compress(data)
+
+    @staticmethod
+    def decompress(data: bytes, method: int) -> bytes:
+        if method == Compression.NONE:
+            return data
+        if method not in Compression._MODULES:
+            raise CompressionException("Invalid compression method")
+        try:
+            return Compression._MODULES[method].decompress(data)
+        except Compression._ERRORS:
+            raise CompressionException("Corrupt compressed payload")
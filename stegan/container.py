@@ -0,0 +1,101 @@
+from struct import calcsize, pack, unpack
+
+from .permutation import Permutation
+from .steganography import Steganography, SteganographyException
+from .vigenere import Vigenere
+
+# Container payload
+# 2 bytes magic header: 0x1339
+# 2 bytes file count: n
+# 4 bytes total size of the file names: k
+# 8 bytes size of each file, n times
+# 2 bytes name size of each file, n times
+# k bytes file names
+# file contents, in index order
+#
+# The contents are encrypted as one stream, so any file can be decrypted
+# on its own from its offset. Listing reads only the index, extracting a
+# file gathers only the symbols of that file.
+MAGIC = 0x1339
+
+
+def _index(files: list) -> bytes:
+    names = [name.encode("latin-1") for name, _ in files]
+    if len(set(names)) != len(names):
+        raise SteganographyException("Duplicate file name")
+    if len(files) > 0xFFFF or any(len(name) > 0xFFFF for name in names):
+        raise SteganographyException("Too many files or file name too long")
+
+    return (
+        pack("HHI", MAGIC, len(files), sum(len(name) for name in names))
+        + pack(f"{len(files)}Q", *[len(content) for _, content in files])
+        + pack(f"{len(files)}H", *[len(name) for name in names])
+        + b"".join(names)
+    )
+
+
+# files is a list of (name, content) or a dict of name to content
+def embed_files(s: Steganography, files, key: str, lsb: int,
+                layout: int = Permutation.LEGACY, track_changes: bool = False):
+    files = list(files.items()) if isinstance(files, dict) else list(files)
+    return s._embed(_index(files), b"".join(content for _, content in files), key, lsb, layout, track_changes)
+
+
+# (names, sizes, offset of the first file) or None without a container
+def _read_index(s: Steganography, seq, lsb: int):
+    header = s._read_header(seq, lsb)
+    if header is None or header[0] != MAGIC:
+        return None
+
+    _, count, names_size = header
+    table_size = count * (calcsize("Q") + calcsize("H"))
+    table = s._read_bytes(seq, lsb, 8, table_size + names_size)
+    if len(table) < table_size + names_size:
+        return None
+
+    sizes = unpack(f"{count}Q", table[:count * 8])
+    name_sizes = unpack(f"{count}H", table[count * 8:table_size])
+
+    names = []
+    offset = table_size
+    for name_size in name_sizes:
+        names.append(table[offset:offset + name_size])
+        offset += name_size
+    return names, sizes, 8 + table_size + names_size
+
+
+# [(name, size), ...] of the files in image, None when it holds no container
+def list_files(image, key: str, lsb: int, layout: int = Permutation.LEGACY):
+    with Steganography._opened(image) as s:
+        s._check_lsb(lsb)
+        index = _read_index(s, s._get_permutation(key, layout), lsb)
+    if index is None:
+        return None
+
+    names, sizes, _ = index
+    return list(zip(names, sizes))
+
+
+def extract_file(image, name, key: str, lsb: int, layout: int = Permutation.LEGACY) -> bytes:
+    with Steganography._opened(image) as s:
+        s._check_lsb(lsb)
+        seq = s._get_permutation(key, layout)
+
+        index = _read_index(s, seq, lsb)
+        if index is None:
+            raise SteganographyException("No container found")
+
+        names, sizes, start = index
+        if isinstance(name, str):
+            name = name.encode("latin-1")
+        if name not in names:
+            raise SteganographyException("File not found")
+
+        i = names.index(name)
+        offset = sum(sizes[:i])
+        content = s._read_bytes(seq, lsb, start + offset, sizes[i])
+
+    if key != "":
+        vigenere = Vigenere(Vigenere.EXTENDED, key=key.encode("utf-8"))
+        content = vigenere.decryptor(offset).update(content)
+    return content
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+# Payload bits are written MSB first, lsb bits per channel, so a symbol is
+# the next lsb bits of the payload read as a big endian integer. The last
+# symbol is zero padded when the bit count is not a multiple of lsb.
+def bytes_to_symbols(data, lsb: int) -> np.ndarray:
+    raw = np.frombuffer(data, dtype=np.uint8)
+
+    if 8 % lsb == 0:
+        shifts = np.arange(8 - lsb, -1, -lsb, dtype=np.uint8)
+        return ((raw[:, None] >> shifts) & ((1 << lsb) - 1)).ravel()
+
+    bits = np.unpackbits(raw)
+    pad = -len(bits) % lsb
+    if pad:
+        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
+    weights = (1 << np.arange(lsb - 1, -1, -1)).astype(np.uint8)
+    return bits.reshape(-1, lsb) @ weights
+
+
+# skip drops that many leading bits, for bytes that start inside a symbol
+def symbols_to_bytes(symbols: np.ndarray, lsb: int, skip: int = 0) -> bytes:
+    symbols = np.asarray(symbols, dtype=np.uint8) & ((1 << lsb) - 1)
+
+    if skip == 0 and 8 % lsb == 0 and len(symbols) % (8 // lsb) == 0:
+        weights = (1 << np.arange(8 - lsb, -1, -lsb)).astype(np.uint8)
+        return (symbols.reshape(-1, 8 // lsb) @ weights).astype(np.uint8).tobytes()
+
+    shifts = np.arange(lsb - 1, -1, -1, dtype=np.uint8)
+    bits = ((symbols[:, None] >> shifts) & 1).ravel()[skip:]
+    bits = bits[:len(bits) // 8 * 8]
+    return np.packbits(bits).tobytes()
+
+
+# The symbols at the given indices of bytes_to_symbols(data, lsb), without
+# computing the others
+def symbols_at(data, lsb: int, indices: np.ndarray) -> np.ndarray:
+    raw = np.frombuffer(data, dtype=np.uint8)
+    bits = np.asarray(indices, dtype=np.int64)[:, None] * lsb + np.arange(lsb)
+    byte = bits >> 3
+    inside = byte < len(raw)
+
+    values = np.zeros(bits.shape, dtype=np.uint8)
+    values[inside] = (raw[byte[inside]] >> (7 - (bits[inside] & 7)).astype(np.uint8)) & 1
+    weights = (1 << np.arange(lsb - 1, -1, -1)).astype(np.uint8)
+    return values @ weights
+
+
+def symbol_count(byte_count: int, lsb: int) -> int:
+    return -(-byte_count * 8 // lsb)
+
+
+# Symbol s lives in channel s % channels of pixel seq[s // channels], so the
+# channels of a pixel are filled in order before moving to the next one.
+def channel_positions(seq, channels: int, start: int, stop: int) -> np.ndarray:
+    if stop <= start:
+        return np.zeros(0, dtype=np.int64)
+
+    pixels = np.asarray(seq[start // channels:-(-stop // channels)], dtype=np.int64)
+    positions = (pixels[:, None] * channels + np.arange(channels)).ravel()
+    offset = start % channels
+    return positions[offset:offset + stop - start]
+
+
+def embed_symbols(flat: np.ndarray, positions: np.ndarray, symbols: np.ndarray, lsb: int):
+    keep = 0xFF ^ ((1 << lsb) - 1)
+    flat[positions] = (flat[positions] & keep) | symbols
+
+
+def gather_symbols(flat: np.ndarray, positions: np.ndarray, lsb: int) -> np.ndarray:
+    return flat[positions] & ((1 << lsb) - 1)
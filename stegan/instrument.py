@@ -0,0 +1,105 @@
+import json
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class PhaseStats:
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.counts = {}
+
+    def as_dict(self) -> dict:
+        return {"seconds": self.seconds, "calls": self.calls, **self.counts}
+
+
+# Timings of one embed or extract. Phases that run once per chunk are
+# summed, so a report has one entry per phase name.
+class OperationReport:
+    def __init__(self, name: str, counts: dict):
+        self.name = name
+        self.seconds = 0.0
+        self.counts = counts
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str, **counts):
+        stats = self.phases.setdefault(name, PhaseStats())
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats.seconds += time.perf_counter() - started
+            stats.calls += 1
+            for count, value in counts.items():
+                stats.counts[count] = stats.counts.get(count, 0) + value
+
+    def timed(self, name: str, iterable, count: str = "bytes"):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, None)
+            if item is None:
+                return
+            self.phases[name].counts[count] = self.phases[name].counts.get(count, 0) + len(item)
+            yield item
+
+    def as_dict(self) -> dict:
+        return {
+            "operation": self.name,
+            "seconds": self.seconds,
+            **self.counts,
+            "phases": {name: stats.as_dict() for name, stats in self.phases.items()},
+        }
+
+
+class _NullReport:
+    _PHASE = nullcontext()
+
+    def phase(self, name: str, **counts):
+        return self._PHASE
+
+    def timed(self, name: str, iterable, count: str = "bytes"):
+        return iterable
+
+
+NULL_REPORT = _NullReport()
+_NULL_OPERATION = nullcontext(NULL_REPORT)
+
+
+class Instrumentation:
+    def __init__(self, *hooks):
+        self._hooks = list(hooks)
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def operation(self, name: str, **counts):
+        # without hooks nothing is timed or allocated
+        if not self._hooks:
+            return _NULL_OPERATION
+        return self._operation(name, counts)
+
+    @contextmanager
+    def _operation(self, name: str, counts: dict):
+        report = OperationReport(name, counts)
+        started = time.perf_counter()
+        try:
+            yield report
+        finally:
+            report.seconds = time.perf_counter() - started
+            for hook in list(self._hooks):
+                hook(report)
+
+
+def logging_hook(logger: logging.Logger = None, level: int = logging.INFO):
+    logger = logger or logging.getLogger("stegan")
+
+    def hook(report: OperationReport):
+        logger.log(level, json.dumps(report.as_dict()))
+
+    return hook
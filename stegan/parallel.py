@@ -0,0 +1,223 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .engine import (
+    bytes_to_symbols,
+    channel_positions,
+    embed_symbols,
+    gather_symbols,
+    symbol_count,
+    symbols_to_bytes,
+)
+from .permutation import Permutation, default_cache
+from .steganography import Steganography, SteganographyException
+from .vigenere import Vigenere
+
+# Embeds into and extracts from one large image with several worker
+# processes. The channel values, the stream to embed and, for the legacy
+# layout, the shuffled pixel order are put in shared memory, and the
+# stream is split into chunks of whole symbols that the workers encrypt
+# and write, or gather, at the same time. Chunks hold disjoint symbols and
+# so touch disjoint channel values, the result is the same as with
+# Steganography.
+
+# stream bytes per chunk, at least
+_MIN_CHUNK = 1 << 18
+# chunks per worker, so a worker that finishes early takes over more
+_CHUNKS_PER_WORKER = 4
+
+
+# (name, shape, dtype) to attach from a worker, and the array in a new
+# shared memory block, added to blocks
+def _create(blocks: list, shape, dtype):
+    shape = tuple(shape)
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    blocks.append(block)
+    return (block.name, shape, dtype.str), np.ndarray(shape, dtype, buffer=block.buf)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype, buffer=block.buf)
+
+
+# Byte ranges of [start, stop) that start on symbol boundaries
+def _chunks(start: int, stop: int, lsb: int, workers: int) -> list:
+    size = max(_MIN_CHUNK, -(-(stop - start) // (workers * _CHUNKS_PER_WORKER)))
+    size = -(-size // lsb) * lsb
+    return [(i, min(i + size, stop)) for i in range(start, stop, size)]
+
+
+# The values, stream and pixel order shared with a pool of workers
+class _SharedImage:
+    def __init__(self, s: Steganography, key: str, layout: int, workers: int, stream_size: int = 0):
+        self._blocks = []
+        self._arrays = []
+        try:
+            pixels = s._get_pixels()
+            self.pixels, self.values = _create(self._blocks, pixels.shape, np.uint8)
+            self.values[...] = pixels
+
+            self.stream, self.data = _create(self._blocks, (stream_size,), np.uint8)
+
+            # the legacy order comes from one shuffle of every pixel, it is
+            # made once here instead of in each worker
+            self.seq = None
+            if layout == Permutation.LEGACY:
+                seq = s._get_permutation(key, layout)[:]
+                self.seq, shared_seq = _create(self._blocks, seq.shape, seq.dtype)
+                shared_seq[:] = seq
+                self._arrays.append(shared_seq)
+
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        executor = getattr(self, "executor", None)
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+        # the arrays export the buffers, they have to go before the blocks
+        self.values = self.data = None
+        self._arrays.clear()
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _worker_permutation(seq, layout: int, key: str, count: int):
+    if seq is not None:
+        return _attach(seq)
+    return None, default_cache.get(layout, key, count)
+
+
+def _embed_chunk(pixels, stream, seq, layout: int, key: str, lsb: int, header_size: int, start: int, stop: int):
+    blocks = []
+    try:
+        block, values = _attach(pixels)
+        blocks.append(block)
+        block, data = _attach(stream)
+        blocks.append(block)
+        block, order = _worker_permutation(seq, layout, key, values.shape[0] * values.shape[1])
+        blocks.append(block)
+
+        chunk = data[start:stop].tobytes()
+        if key != "" and stop > header_size:
+            plain = max(0, header_size - start)
+            vigenere = Vigenere(Vigenere.EXTENDED, key=key.encode("utf-8"))
+            chunk = chunk[:plain] + vigenere.encryptor(start + plain - header_size).update(chunk[plain:])
+
+        channels = values.shape[2] if values.ndim == 3 else 1
+        first = start * 8 // lsb
+        symbols = bytes_to_symbols(chunk, lsb)
+        positions = channel_positions(order, channels, first, first + len(symbols))
+        embed_symbols(values.reshape(-1), positions, symbols, lsb)
+    finally:
+        values = data = order = None
+        for block in blocks:
+            if block is not None:
+                block.close()
+
+
+def _gather_chunk(pixels, seq, layout: int, key: str, lsb: int, start: int, stop: int) -> bytes:
+    blocks = []
+    try:
+        block, values = _attach(pixels)
+        blocks.append(block)
+        block, order = _worker_permutation(seq, layout, key, values.shape[0] * values.shape[1])
+        blocks.append(block)
+
+        channels = values.shape[2] if values.ndim == 3 else 1
+        flat = values.reshape(-1)
+        first = start * 8 // lsb
+        positions = channel_positions(order, channels, first, min(symbol_count(stop, lsb), flat.size))
+        return symbols_to_bytes(gather_symbols(flat, positions, lsb), lsb)[:stop - start]
+    finally:
+        values = flat = order = None
+        for block in blocks:
+            if block is not None:
+                block.close()
+
+
+def _cover(image) -> Steganography:
+    return image if isinstance(image, Steganography) else Steganography(image)
+
+
+# Like Steganography.set_stego_payload, with workers processes, all cores
+# by default. Returns the Steganography holding the stego image.
+def embed(image, filename: str, payload: bytes, key: str, lsb: int, layout: int = Permutation.LEGACY,
+          compression: int = None, workers: int = None) -> Steganography:
+    s = _cover(image)
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        s.set_stego_payload(filename, payload, key, lsb, layout=layout, compression=compression)
+        return s
+
+    s._check_lsb(lsb)
+    header, payload = s._prepare_payload(filename, payload, compression)
+    total = len(header) + len(payload)
+    if total > s.get_payload_size(lsb):
+        raise SteganographyException("Payload too big")
+    s._get_permutation(key, layout)
+
+    with _SharedImage(s, key, layout, workers, total) as shared:
+        shared.data[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+        shared.data[len(header):] = np.frombuffer(payload, dtype=np.uint8)
+
+        futures = [
+            shared.executor.submit(_embed_chunk, shared.pixels, shared.stream, shared.seq, layout, key, lsb,
+                                   len(header), start, stop)
+            for start, stop in _chunks(0, total, lsb, workers)
+        ]
+        for future in futures:
+            future.result()
+        s._payloaded_pixel = shared.values.copy()
+    return s
+
+
+# Like Steganography.get_stego_payload, with workers processes, all cores
+# by default. The header is read in this process, only long reads are
+# split over the workers.
+def extract(image, key: str, lsb: int, layout: int = Permutation.LEGACY, workers: int = None):
+    workers = workers or os.cpu_count()
+    with Steganography._opened(image) as s:
+        if workers == 1:
+            return s.get_stego_payload(key, lsb, layout)
+
+        s._check_lsb(lsb)
+        seq = s._get_permutation(key, layout)
+        shared = None
+
+        def read(start: int, length: int) -> bytes:
+            nonlocal shared
+            if length < _MIN_CHUNK:
+                return s._read_bytes(seq, lsb, start, length)
+
+            if shared is None:
+                shared = _SharedImage(s, key, layout, workers)
+            aligned = start - start % lsb
+            futures = [
+                shared.executor.submit(_gather_chunk, shared.pixels, shared.seq, layout, key, lsb, first, stop)
+                for first, stop in _chunks(aligned, start + length, lsb, workers)
+            ]
+            return b"".join(future.result() for future in futures)[start - aligned:]
+
+        try:
+            return s._parse_payload(read, key)
+        finally:
+            if shared is not None:
+                shared.close()
@@ -0,0 +1,322 @@
+import hashlib
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Permutation:
+    LEGACY = 1
+    KEYED = 2
+    SEQUENTIAL = 3
+    TILED = 4
+    NAMES = {"legacy": LEGACY, "keyed": KEYED, "sequential": SEQUENTIAL, "tiled": TILED}
+
+    _CHUNK = 1 << 16
+    _OVERHEAD = 512
+    # positions come in raster order, so a prefix of the image is enough
+    sequential = False
+
+    def __init__(self, count: int):
+        self._count = count
+
+    @staticmethod
+    def create(layout: int, key: str, count: int) -> "Permutation":
+        if layout == Permutation.LEGACY:
+            return LegacyPermutation(key, count)
+        elif layout == Permutation.KEYED:
+            return KeyedPermutation(key, count)
+        elif layout == Permutation.SEQUENTIAL:
+            return SequentialPermutation(count)
+        elif layout == Permutation.TILED:
+            return TiledPermutation(key, count)
+        raise ValueError("Invalid permutation layout")
+
+    def _lookup(self, indices: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    # bytes held once the permutation is fully used
+    def nbytes(self) -> int:
+        return self._OVERHEAD
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            return self._lookup(np.arange(start, stop, step, dtype=np.int64))
+
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("Permutation index out of range")
+        return int(self._lookup(np.array([index], dtype=np.int64))[0])
+
+    def __iter__(self):
+        for start in range(0, self._count, self._CHUNK):
+            yield from self[start:start + self._CHUNK].tolist()
+
+
+# Same order as the original implementation: the full list of pixel indices
+# shuffled with random seeded from every other character of the key. The
+# whole shuffle has to run before the first position is known.
+class LegacyPermutation(Permutation):
+    def __init__(self, key: str, count: int):
+        super().__init__(count)
+        self._seed = self.seed(key)
+        self._seq = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def seed(key: str):
+        if key != "":
+            return sum([ord(key[i]) for i in range(0, len(key), 2)])
+        return key
+
+    def _get_sequence(self) -> np.ndarray:
+        with self._lock:
+            if self._seq is None:
+                seq = list(range(self._count))
+                random.Random(self._seed).shuffle(seq)
+                self._seq = np.array(seq, dtype=self._dtype())
+        return self._seq
+
+    def _dtype(self):
+        return np.int32 if self._count < 2**31 else np.int64
+
+    def nbytes(self) -> int:
+        return self._OVERHEAD + self._count * np.dtype(self._dtype()).itemsize
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._get_sequence()[index]
+        return super().__getitem__(index)
+
+    def _lookup(self, indices: np.ndarray) -> np.ndarray:
+        return self._get_sequence()[indices]
+
+
+# Keyed Feistel network over the smallest power of two domain holding
+# count, walked in cycles until it lands back in range. The two halves may
+# differ by a bit, so each round xors one half with a keyed hash of the
+# other, alternating sides. Any position can be computed on its own, so
+# only the positions actually used are generated.
+class KeyedPermutation(Permutation):
+    _ROUNDS = 6
+
+    # tweak gives independent orders for the same key and count
+    def __init__(self, key: str, count: int, tweak: int = 0):
+        super().__init__(count)
+        self._round_keys = self._derive_round_keys(key, count, tweak)[:, None]
+
+    @classmethod
+    def _derive_round_keys(cls, key: str, count: int, tweak: int = 0) -> np.ndarray:
+        digest = hashlib.blake2b(
+            key.encode("utf-8"),
+            digest_size=8 * cls._ROUNDS,
+            salt=(count + (tweak << 64)).to_bytes(16, "little")
+        ).digest()
+        return np.frombuffer(digest, dtype=np.uint64)
+
+    @staticmethod
+    def _mix(x: np.ndarray) -> np.ndarray:
+        # splitmix64 finalizer
+        x = x ^ (x >> np.uint64(30))
+        x = x * np.uint64(0xBF58476D1CE4E5B9)
+        x = x ^ (x >> np.uint64(27))
+        x = x * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+    # round_keys has one row per round and either a single column or one
+    # column per value in x
+    @classmethod
+    def _encrypt(cls, count: int, x: np.ndarray, round_keys: np.ndarray) -> np.ndarray:
+        bits = max(2, (count - 1).bit_length())
+        right_bits = np.uint64(bits // 2)
+        right_mask = np.uint64((1 << (bits // 2)) - 1)
+        left_mask = np.uint64((1 << (bits - bits // 2)) - 1)
+
+        left = x >> right_bits
+        right = x & right_mask
+        for i, round_key in enumerate(round_keys):
+            if i % 2 == 0:
+                right ^= cls._mix(left ^ round_key) & right_mask
+            else:
+                left ^= cls._mix(right ^ round_key) & left_mask
+        return (left << right_bits) | right
+
+    @classmethod
+    def _walk(cls, count: int, x: np.ndarray, round_keys: np.ndarray) -> np.ndarray:
+        result = cls._encrypt(count, x.astype(np.uint64), round_keys)
+        outside = np.flatnonzero(result >= count)
+        while len(outside):
+            keys = round_keys if round_keys.shape[1] == 1 else round_keys[:, outside]
+            result[outside] = cls._encrypt(count, result[outside], keys)
+            outside = outside[result[outside] >= count]
+        return result.astype(np.int64)
+
+    def _lookup(self, indices: np.ndarray) -> np.ndarray:
+        return self._walk(self._count, indices, self._round_keys)
+
+    # The same indices under many keys at once, one row per key
+    @classmethod
+    def lookup_many(cls, keys, count: int, indices: np.ndarray) -> np.ndarray:
+        if len(keys) == 0:
+            return np.zeros((0, len(indices)), dtype=np.int64)
+
+        round_keys = np.stack([cls._derive_round_keys(key, count) for key in keys], axis=1)
+        round_keys = np.repeat(round_keys, len(indices), axis=1)
+        x = np.tile(np.asarray(indices, dtype=np.int64), len(keys))
+        return cls._walk(count, x, round_keys).reshape(len(keys), len(indices))
+
+
+# Pixels in raster order, the key is not used
+class SequentialPermutation(Permutation):
+    sequential = True
+
+    def _lookup(self, indices: np.ndarray) -> np.ndarray:
+        return indices
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.arange(*index.indices(self._count), dtype=np.int64)
+        return super().__getitem__(index)
+
+
+# The pixels are split into tiles of TILE_PIXELS consecutive pixels in
+# raster order, the last one possibly shorter. Pixel slots are dealt to
+# the tiles round by round in a keyed tile order, so a payload is spread
+# over the whole image, and each tile orders its own pixels with a keyed
+# Feistel network of its own. The pixels of a tile only depend on the
+# tile, so the image can be processed one tile at a time.
+class TiledPermutation(Permutation):
+    TILE_PIXELS = 1 << 18
+
+    def __init__(self, key: str, count: int, tile_pixels: int = TILE_PIXELS):
+        super().__init__(count)
+        self.tile_pixels = tile_pixels
+        self.tiles = max(1, -(-count // tile_pixels))
+        # slots below _shared go to every tile, the rest skip the last one
+        self._last_pixels = count - (self.tiles - 1) * tile_pixels
+        self._shared = self.tiles * self._last_pixels
+
+        self._order = KeyedPermutation(key, self.tiles)[:]
+        self._rank = np.argsort(self._order)
+        self._order_full = self._order[self._order != self.tiles - 1]
+        self._rank_full = np.zeros(self.tiles, dtype=np.int64)
+        self._rank_full[self._order_full] = np.arange(len(self._order_full))
+
+        self._round_keys = np.stack([
+            KeyedPermutation._derive_round_keys(key, self.tile_size(tile), tile + 1)
+            for tile in range(self.tiles)
+        ], axis=1)
+
+    def tile_size(self, tile: int) -> int:
+        return self._last_pixels if tile == self.tiles - 1 else self.tile_pixels
+
+    def nbytes(self) -> int:
+        return self._OVERHEAD + self.tiles * (KeyedPermutation._ROUNDS + 4) * 8
+
+    def _in_tile(self, tiles: np.ndarray, j: np.ndarray) -> np.ndarray:
+        result = np.empty(len(j), dtype=np.int64)
+        last = tiles == self.tiles - 1
+        for mask, size in ((~last, self.tile_pixels), (last, self._last_pixels)):
+            if mask.any():
+                result[mask] = KeyedPermutation._walk(size, j[mask], self._round_keys[:, tiles[mask]])
+        return result
+
+    def _lookup(self, indices: np.ndarray) -> np.ndarray:
+        indices = np.asarray(indices, dtype=np.int64)
+        shared = indices < self._shared
+        rest = indices[~shared] - self._shared
+
+        tiles = np.empty(len(indices), dtype=np.int64)
+        j = np.empty(len(indices), dtype=np.int64)
+        tiles[shared] = self._order[indices[shared] % self.tiles]
+        j[shared] = indices[shared] // self.tiles
+        if len(rest):
+            tiles[~shared] = self._order_full[rest % (self.tiles - 1)]
+            j[~shared] = self._last_pixels + rest // (self.tiles - 1)
+
+        return tiles * self.tile_pixels + self._in_tile(tiles, j)
+
+    # number of slots of tile below slot index stop
+    def _slots_below(self, tile: int, stop: int) -> int:
+        below = min(self._last_pixels, max(0, -(-(stop - self._rank[tile]) // self.tiles)))
+        if stop > self._shared and tile != self.tiles - 1:
+            rest = -(-(stop - self._shared - self._rank_full[tile]) // (self.tiles - 1))
+            below += min(self.tile_pixels - self._last_pixels, max(0, rest))
+        return below
+
+    # (slots, pixels) of the slots in [start, stop) that fall in tile, the
+    # pixels counted from the start of the tile
+    def tile_slots(self, tile: int, start: int, stop: int):
+        j = np.arange(self._slots_below(tile, start), self._slots_below(tile, stop), dtype=np.int64)
+        slots = np.where(
+            j < self._last_pixels,
+            j * self.tiles + self._rank[tile],
+            self._shared + (j - self._last_pixels) * (self.tiles - 1) + self._rank_full[tile]
+        )
+        pixels = KeyedPermutation._walk(self.tile_size(tile), j, self._round_keys[:, tile:tile + 1])
+        return slots, pixels
+
+    # the last tile, in raster order, holding any slot below stop
+    def last_tile(self, stop: int) -> int:
+        if stop >= self.tiles:
+            return self.tiles - 1
+        return int(self._order[:max(stop, 1)].max())
+
+
+# LRU of permutations keyed by what determines their order, bounded by the
+# bytes the permutations hold. Legacy keys with the same seed share one
+# entry. Shared between threads.
+class PermutationCache:
+    DEFAULT_BUDGET = 128 << 20
+
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        self._budget = budget
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(layout: int, key: str, count: int):
+        if layout == Permutation.LEGACY:
+            return layout, LegacyPermutation.seed(key), count
+        elif layout == Permutation.SEQUENTIAL:
+            return layout, None, count
+        return layout, key, count
+
+    def get(self, layout: int, key: str, count: int) -> Permutation:
+        cache_key = self._cache_key(layout, key, count)
+
+        with self._lock:
+            if cache_key in self._entries:
+                self._entries.move_to_end(cache_key)
+                return self._entries[cache_key]
+
+        permutation = Permutation.create(layout, key, count)
+        if permutation.nbytes() > self._budget:
+            return permutation
+
+        with self._lock:
+            if cache_key in self._entries:
+                return self._entries[cache_key]
+
+            self._entries[cache_key] = permutation
+            self._size += permutation.nbytes()
+            while self._size > self._budget:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes()
+
+        return permutation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+default_cache = PermutationCache()
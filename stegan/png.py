@@ -0,0 +1,224 @@
+import io
+import zlib
+from struct import pack, unpack
+
+import numpy as np
+from PIL import Image
+
+
+class PngException(Exception):
+    pass
+
+
+# Reads the rows of a non-interlaced 8 bit L, RGB, RGBA or palette PNG one
+# at a time, decompressing and unfiltering strips of rows only as far as
+# the rows read so far need. Values are the same as PIL decodes them,
+# palette images give palette indices.
+class PngRowReader:
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+    # color type: channels
+    _CHANNELS = {0: 1, 2: 3, 3: 1, 6: 4}
+    _READ_SIZE = 1 << 16
+    _STRIP_SIZE = 1 << 18
+
+    def __init__(self, f):
+        self._f = f
+        if f.read(8) != self.SIGNATURE:
+            raise PngException("Not a PNG file")
+
+        chunk_type, data = self._read_chunk()
+        if chunk_type != b"IHDR":
+            raise PngException("Missing IHDR chunk")
+        self.width, self.height, depth, self.color_type, _, _, interlace = unpack(">IIBBBBB", data[:13])
+        if depth != 8 or self.color_type not in self._CHANNELS or interlace != 0:
+            raise PngException("Unsupported PNG format")
+        self.channels = self._CHANNELS[self.color_type]
+
+        # chunks before the image data, palette and metadata
+        self.chunks = []
+        self._idat_done = False
+        while True:
+            length, chunk_type = unpack(">I4s", self._read_exact(8))
+            if chunk_type == b"IDAT":
+                break
+            if chunk_type == b"IEND":
+                raise PngException("Missing image data")
+            self.chunks.append((chunk_type, self._read_exact(length)))
+            self._read_exact(4)
+        self._idat_left = length
+        if length == 0:
+            self._read_exact(4)
+
+        self._decompressor = zlib.decompressobj()
+        self._raw = bytearray()
+        self._prev = np.zeros(self.width * self.channels, dtype=np.uint8)
+        self._strip = np.zeros((0, self.width * self.channels), dtype=np.uint8)
+        self._next = 0
+        self.rows_read = 0
+
+    def _read_chunk(self):
+        length, chunk_type = unpack(">I4s", self._read_exact(8))
+        data = self._read_exact(length)
+        self._read_exact(4)
+        return chunk_type, data
+
+    def _read_exact(self, size: int) -> bytes:
+        data = self._f.read(size)
+        if len(data) != size:
+            raise PngException("Truncated PNG file")
+        return data
+
+    # next piece of compressed image data, b"" after the last IDAT chunk
+    def _read_idat(self) -> bytes:
+        while self._idat_left == 0 and not self._idat_done:
+            length, chunk_type = unpack(">I4s", self._read_exact(8))
+            if chunk_type == b"IDAT":
+                self._idat_left = length
+                if length == 0:
+                    self._read_exact(4)
+            elif chunk_type == b"IEND":
+                self._idat_done = True
+            else:
+                self._read_exact(length + 4)
+
+        if self._idat_done:
+            return b""
+
+        data = self._read_exact(min(self._idat_left, self._READ_SIZE))
+        self._idat_left -= len(data)
+        if self._idat_left == 0:
+            self._read_exact(4)
+        return data
+
+    def read_row(self) -> np.ndarray:
+        if self.rows_read >= self.height:
+            raise PngException("No more rows")
+
+        if self._next >= len(self._strip):
+            self._read_strip()
+        row = self._strip[self._next]
+        self._next += 1
+
+        self.rows_read += 1
+        if self.rows_read == self.height:
+            self._f.close()
+        return row
+
+    # inflates and unfilters the next rows, about _STRIP_SIZE bytes of them
+    def _read_strip(self):
+        size = self.width * self.channels + 1
+        count = min(self.height - self.rows_read, max(1, self._STRIP_SIZE // size))
+        while len(self._raw) < size * count:
+            data = self._decompressor.unconsumed_tail or self._read_idat()
+            if not data:
+                raise PngException("Truncated image data")
+            try:
+                self._raw += self._decompressor.decompress(data, max(size * count - len(self._raw), self._READ_SIZE))
+            except zlib.error:
+                raise PngException("Corrupt image data")
+
+        raw = bytes(self._raw[:size * count])
+        del self._raw[:size * count]
+        self._strip = _unfilter(raw, self._prev, self.width, self.channels)
+        self._prev = self._strip[-1]
+        self._next = 0
+
+    def close(self):
+        self._f.close()
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return pack(">I", len(data)) + chunk_type + data + pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+
+
+# channels: color type the rows are unfiltered as
+_STRIP_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+
+
+# Undoes the row filters of raw, whole filtered rows that follow the
+# decoded row prev, in C: the rows go into a small in-memory PNG, after
+# prev stored unfiltered so the first row sees it as the row above, and
+# PIL decodes that. Unfiltering only depends on the bytes per pixel, so
+# palette indices are decoded as L.
+def _unfilter(raw: bytes, prev: np.ndarray, width: int, channels: int) -> np.ndarray:
+    rows = len(raw) // (width * channels + 1)
+    data = b"\0" + prev.tobytes() + raw
+    png = (
+        PngRowReader.SIGNATURE
+        + _chunk(b"IHDR", pack(">IIBBBBB", width, rows + 1, 8, _STRIP_COLOR_TYPES[channels], 0, 0, 0))
+        + _chunk(b"IDAT", zlib.compress(data, 0))
+        + _chunk(b"IEND", b"")
+    )
+    try:
+        with Image.open(io.BytesIO(png)) as img:
+            values = np.asarray(img)
+    except (OSError, SyntaxError, ValueError):
+        raise PngException("Invalid row filter")
+    return values.reshape(rows + 1, width * channels)[1:]
+
+
+# Writes a PNG with the same format as a PngRowReader, a row or a block of
+# rows at a time. Rows are Sub filtered, palette rows are not filtered.
+class PngRowWriter:
+    _IDAT_SIZE = 1 << 16
+
+    def __init__(self, f, width: int, height: int, color_type: int, chunks=(), compress_level: int = 6):
+        self._f = f
+        self._channels = PngRowReader._CHANNELS[color_type]
+        self._filter = 0 if color_type == 3 else 1
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = bytearray()
+
+        f.write(PngRowReader.SIGNATURE)
+        self._write_chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        for chunk_type, data in chunks:
+            self._write_chunk(chunk_type, data)
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes):
+        self._f.write(_chunk(chunk_type, data))
+
+    def write_row(self, row: np.ndarray):
+        self.write_rows(row.reshape(1, -1))
+
+    # rows is a (count, row size) array, filtered and compressed in one go
+    def write_rows(self, rows: np.ndarray):
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = self._filter
+        filtered[:, 1:] = rows
+        if self._filter == 1:
+            filtered[:, 1 + self._channels:] -= rows[:, :-self._channels]
+
+        self._pending += self._compressor.compress(filtered.tobytes())
+        if len(self._pending) >= self._IDAT_SIZE:
+            self._write_chunk(b"IDAT", bytes(self._pending))
+            self._pending.clear()
+
+    def close(self):
+        self._pending += self._compressor.flush()
+        self._write_chunk(b"IDAT", bytes(self._pending))
+        self._write_chunk(b"IEND", b"")
+
+
+# Flat channel values of an image in raster order, decoded from a row
+# reader only up to the highest position asked for so far
+class RowValues:
+    def __init__(self, reader: PngRowReader):
+        self._reader = reader
+        self._row_size = reader.width * reader.channels
+        self.size = self._row_size * reader.height
+        self._values = np.empty(self.size, dtype=np.uint8)
+        self._filled = 0
+
+    def _fill(self, count: int):
+        while self._filled < count:
+            self._values[self._filled:self._filled + self._row_size] = self._reader.read_row()
+            self._filled += self._row_size
+
+    def __getitem__(self, positions) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions):
+            self._fill(int(positions.max()) + 1)
+        return self._values[positions]
+
+    def close(self):
+        self._reader.close()
@@ -1,41 +1,139 @@
 from PIL import Image
-from math import log10
+from math import inf, log10
 
-def mse(img1, img2):
-    size1 = img1.size
-    size2 = img2.size
-    if size1 != size2:
+import numpy as np
+
+# pixels compared per block, to keep the difference buffer small
+_BLOCK_PIXELS = 1 << 18
+# squared 8 bit differences summed over this many values still fit in int32
+_RUN = 1 << 15
+
+
+# A palette without transparency has no alpha to compare, as RGBA it would
+# only add a constant band
+def _palette_mode(images, alpha: bool) -> str:
+    transparent = any(img.mode == "P" and "transparency" in img.info for img in images)
+    return "RGBA" if alpha and transparent else "RGB"
+
+
+def _bands(img: Image, alpha: bool, palette_mode: str = "RGB"):
+    # palette images are compared by color, not by palette index
+    if img.mode == "P":
+        img = img.convert(palette_mode)
+
+    bands = img.getbands()
+    data = np.asarray(img).reshape(img.height, img.width, len(bands))
+
+    if "A" in bands and not alpha:
+        keep = [i for i, band in enumerate(bands) if band != "A"]
+        return tuple(bands[i] for i in keep), data[..., keep]
+    return bands, data
+
+
+def squared_error(img1, img2, alpha: bool = False) -> dict:
+    if img1.size != img2.size:
         raise Exception("Size is different")
 
-    data1 = img1.getdata()
-    data2 = img2.getdata()
-
-    mode = img1.mode
-
-    w, h = size1
-    total = 0
-    for x in range(w):
-        for y in range(h):
-            index = x + w*y
-            if mode in ["RGB", "RGBA"]:
-                r1, g1, b1 = data1[index][:3]
-                r2, g2, b2 = data2[index][:3]
-                dr = (r1 - r2)**2
-                dg = (g1 - g2)**2
-                db = (b1 - b2)**2
-                total += dr + dg + db
-            elif mode in ["L", "P"]:
-                p1 = data1[index]
-                p2 = data2[index]
-                total += (p1 - p2) ** 2
-    
-    total /= w * h
-    total /= 3
-    return total
-
-def psnr(img1, img2):
-    mse_res = mse(img1, img2)
+    palette_mode = _palette_mode((img1, img2), alpha)
+    bands1, data1 = _bands(img1, alpha, palette_mode)
+    bands2, data2 = _bands(img2, alpha, palette_mode)
+    if bands1 != bands2:
+        raise Exception("Mode is different")
+
+    # int32 differences, squared and summed in int32 over runs short enough
+    # not to overflow, then added up in int64
+    data1 = data1.reshape(-1, len(bands1))
+    data2 = data2.reshape(-1, len(bands1))
+    total = np.zeros(len(bands1), dtype=np.int64)
+    for start in range(0, len(data1), _BLOCK_PIXELS):
+        diff = np.subtract(data1[start:start + _BLOCK_PIXELS], data2[start:start + _BLOCK_PIXELS], dtype=np.int32)
+        whole = len(diff) // _RUN * _RUN
+        runs = diff[:whole].reshape(-1, _RUN, len(bands1))
+        total += np.einsum("kij,kij->kj", runs, runs).sum(axis=0, dtype=np.int64)
+        total += np.einsum("ij,ij->j", diff[whole:], diff[whole:], dtype=np.int64)
+
+    return dict(zip(bands1, total.tolist()))
+
+
+def _mse_per_channel(errors: dict, pixels_count: int) -> dict:
+    return {band: total / pixels_count for band, total in errors.items()}
+
+
+def _mean(per_channel: dict) -> float:
+    return sum(per_channel.values()) / len(per_channel)
+
+
+def mse_per_channel(img1, img2, alpha: bool = False) -> dict:
+    w, h = img1.size
+    return _mse_per_channel(squared_error(img1, img2, alpha), w * h)
+
+
+def mse(img1, img2, alpha: bool = False) -> float:
+    return _mean(mse_per_channel(img1, img2, alpha))
+
+
+def psnr_from_mse(mse_res: float) -> float:
+    if mse_res == 0:
+        return inf
+
     b = 8
     maxi = 2**b - 1
 
-    return 10 * log10(maxi**2 / mse_res)
\ No newline at end of file
+    return 10 * log10(maxi**2 / mse_res)
+
+
+def psnr_per_channel(img1, img2, alpha: bool = False) -> dict:
+    return {band: psnr_from_mse(res) for band, res in mse_per_channel(img1, img2, alpha).items()}
+
+
+def psnr(img1, img2, alpha: bool = False) -> float:
+    return psnr_from_mse(mse(img1, img2, alpha))
+
+
+# Channel values changed by an embed. Gives the same numbers as comparing
+# the base and the stego image, in O(changed values) instead of O(image).
+class ChangeSet:
+    def __init__(self, image: Image, positions: np.ndarray, old: np.ndarray, new: np.ndarray):
+        self.positions = positions
+        self.old = old
+        self.new = new
+        self._image = image
+
+    def _palette_colors(self, alpha: bool) -> np.ndarray:
+        strip = Image.new("P", (256, 1))
+        strip.putdata(range(256))
+        strip.putpalette(self._image.getpalette())
+        if "transparency" in self._image.info:
+            strip.info["transparency"] = self._image.info["transparency"]
+        strip = strip.convert("RGBA" if alpha else "RGB")
+        return np.asarray(strip).reshape(256, -1)
+
+    def squared_error(self, alpha: bool = False) -> dict:
+        if self._image.mode == "P":
+            alpha = _palette_mode([self._image], alpha) == "RGBA"
+            bands = ("R", "G", "B", "A") if alpha else ("R", "G", "B")
+            colors = self._palette_colors(alpha)
+            diff = colors[self.new].astype(np.float64) - colors[self.old]
+            return dict(zip(bands, np.einsum("ij,ij->j", diff, diff).astype(np.int64).tolist()))
+
+        bands = self._image.getbands()
+        diff = self.new.astype(np.float64) - self.old
+        total = np.bincount(self.positions % len(bands), weights=diff * diff, minlength=len(bands))
+        errors = dict(zip(bands, total.astype(np.int64).tolist()))
+
+        if "A" in errors and not alpha:
+            del errors["A"]
+        return errors
+
+    def mse_per_channel(self, alpha: bool = False) -> dict:
+        w, h = self._image.size
+        return _mse_per_channel(self.squared_error(alpha), w * h)
+
+    def mse(self, alpha: bool = False) -> float:
+        return _mean(self.mse_per_channel(alpha))
+
+    def psnr_per_channel(self, alpha: bool = False) -> dict:
+        return {band: psnr_from_mse(res) for band, res in self.mse_per_channel(alpha).items()}
+
+    def psnr(self, alpha: bool = False) -> float:
+        return psnr_from_mse(self.mse(alpha))
@@ -0,0 +1,152 @@
+from concurrent.futures import ProcessPoolExecutor
+from struct import calcsize, pack, unpack
+
+from PIL import Image
+
+from .permutation import Permutation
+from .steganography import Steganography, SteganographyException
+from .vigenere import Vigenere
+
+# Shard payload
+# 2 bytes magic header: 0x1338
+# 2 bytes filename size: n
+# 4 bytes shard content size: m
+# 4 bytes shard index
+# 4 bytes shard count
+# 8 bytes total content size
+# n bytes filename
+# m bytes shard content
+#
+# Shard i holds the content bytes right after those of shards 0 to i - 1.
+MAGIC = 0x1338
+_SHARD_HEADER = "IIQ"
+_HEADER_SIZE = 8 + calcsize(_SHARD_HEADER)
+
+
+def _header(filename: str, length: int, index: int, count: int, total: int) -> bytes:
+    return (
+        pack("HHI", MAGIC, len(filename), length)
+        + pack(_SHARD_HEADER, index, count, total)
+        + filename.encode("latin-1")
+    )
+
+
+# Splits size bytes over the covers in proportion to the content each one
+# can hold, so every cover is filled to about the same fraction
+def _split(size: int, available: list) -> list:
+    capacity = sum(available)
+    if size > capacity:
+        raise SteganographyException("Payload too big")
+
+    sizes = [size * a // capacity if capacity else 0 for a in available]
+    for i in sorted(range(len(sizes)), key=lambda i: available[i] - sizes[i], reverse=True):
+        if sum(sizes) == size:
+            break
+        sizes[i] += 1
+    return sizes
+
+
+def _embed_shard(cover: str, output: str, header: bytes, content: bytes, key: str, lsb: int, layout: int):
+    s = Steganography(cover)
+    s._embed(header, content, key, lsb, layout)
+    s.get_stego_image().save(output)
+
+
+# Splits payload over the cover images and writes one stego image per
+# cover to outputs. The covers are embedded in parallel worker processes.
+# Covers too small for a shard header with some content get no shard and
+# no output, and are not counted in the shard count. Returns the number of
+# content bytes in each cover, 0 for those left out.
+def embed_shards(covers: list, outputs: list, filename: str, payload: bytes, key: str, lsb: int,
+                 layout: int = Permutation.LEGACY, workers: int = None) -> list:
+    if len(covers) != len(outputs):
+        raise SteganographyException("Need one output per cover")
+    if not covers:
+        raise SteganographyException("Need at least one cover")
+
+    available = []
+    for cover in covers:
+        with Image.open(cover) as img:
+            capacity = Steganography(img).get_payload_size(lsb)
+        available.append(max(0, capacity - _HEADER_SIZE - len(filename.encode("latin-1"))))
+    used = [i for i, room in enumerate(available) if room > 0]
+    if not used:
+        raise SteganographyException("No cover can hold a shard")
+
+    sizes = [0] * len(covers)
+    for i, size in zip(used, _split(len(payload), [available[i] for i in used])):
+        sizes[i] = size
+
+    jobs = []
+    offset = 0
+    for index, i in enumerate(used):
+        header = _header(filename, sizes[i], index, len(used), len(payload))
+        jobs.append((covers[i], outputs[i], header, payload[offset:offset + sizes[i]], key, lsb, layout))
+        offset += sizes[i]
+
+    if workers == 1 or len(jobs) == 1:
+        for job in jobs:
+            _embed_shard(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_embed_shard, *zip(*jobs)))
+
+    return sizes
+
+
+# (index, count, total, filename, content) of the shard in image, None when
+# it holds no shard
+def read_shard(image, key: str, lsb: int, layout: int = Permutation.LEGACY):
+    with Steganography._opened(image) as s:
+        s._check_lsb(lsb)
+        seq = s._get_permutation(key, layout)
+
+        header = s._read_header(seq, lsb)
+        if header is None or header[0] != MAGIC:
+            return None
+
+        _, len_filename, len_content = header
+        index, count, total = unpack(_SHARD_HEADER, s._read_bytes(seq, lsb, 8, calcsize(_SHARD_HEADER)))
+        payload = s._read_bytes(seq, lsb, _HEADER_SIZE, len_filename + len_content)
+    filename = payload[:len_filename]
+    content = payload[len_filename:len_filename + len_content]
+
+    if key != "":
+        vigenere = Vigenere(Vigenere.EXTENDED, key=key.encode("utf-8"))
+        content = vigenere.decrypt(content)
+
+    return index, count, total, filename, content
+
+
+# Reassembles a sharded payload from stego images in any order. Images
+# without a shard are skipped. Returns (filename, content).
+def extract_shards(images: list, key: str, lsb: int, layout: int = Permutation.LEGACY, workers: int = None):
+    if workers == 1 or len(images) <= 1:
+        shards = [read_shard(image, key, lsb, layout) for image in images]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shards = list(executor.map(
+                read_shard,
+                images,
+                [key] * len(images),
+                [lsb] * len(images),
+                [layout] * len(images)
+            ))
+    shards = [shard for shard in shards if shard is not None]
+    if not shards:
+        raise SteganographyException("No shard found")
+
+    _, count, total, filename, _ = shards[0]
+    pieces = {}
+    for index, shard_count, shard_total, shard_filename, content in shards:
+        if (shard_count, shard_total, shard_filename) != (count, total, filename) or index >= count:
+            raise SteganographyException("Shards are from different payloads")
+        pieces[index] = content
+
+    if len(pieces) != count:
+        raise SteganographyException("Missing shard")
+
+    content = b"".join(pieces[index] for index in range(count))
+    if len(content) != total:
+        raise SteganographyException("Shard sizes do not match the total size")
+    return filename, content
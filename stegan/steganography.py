@@ -1,12 +1,28 @@
 from PIL import Image
-from bitstring import BitArray
+from .compression import Compression, CompressionException
+from .engine import (
+    bytes_to_symbols,
+    channel_positions,
+    embed_symbols,
+    gather_symbols,
+    symbol_count,
+    symbols_to_bytes
+)
+from .instrument import NULL_REPORT, Instrumentation
+from .permutation import Permutation, PermutationCache, default_cache
+from .png import PngException, PngRowReader, RowValues
+from .psnr import ChangeSet
 from .vigenere import Vigenere
 from struct import (
     pack,
     unpack
 )
 
-import random
+import os
+from contextlib import contextmanager
+from itertools import chain
+
+import numpy as np
 
 
 class SteganographyException(Exception):
@@ -15,6 +31,12 @@ class SteganographyException(Exception):
 
 class Steganography:
     __SUPPORTED_MODE = ["RGB", "RGBA", "L", "P"]
+    MAGIC = 0x1337
+    VERSIONED_MAGIC = 0x133A
+    VERSION = 1
+    _CHUNK_SIZE = 1 << 16
+    # longest prefix of values read row by row, see _values
+    _STREAM_VALUES = 1 << 22
 
     # Inserted payload
     # 2 bytes magic header: 0x1337
@@ -22,154 +44,320 @@ class Steganography:
     # 4 bytes content size: m
     # n bytes filename
     # m bytes content
-    def __init__(self, filename: str):
-        self._base_image = Image.open(filename)
+    #
+    # With compression the versioned header is used instead
+    # 2 bytes magic header: 0x133A
+    # 2 bytes filename size: n
+    # 4 bytes stored content size: m
+    # 1 byte version: 1
+    # 1 byte compression method
+    # n bytes filename
+    # m bytes compressed content
+    #
+    # The cover is decoded once and permutations come from a shared cache,
+    # so one instance can run many embeds and extracts with different keys,
+    # lsb and payloads.
+    def __init__(self, filename, cache: PermutationCache = None):
+        if isinstance(filename, Image.Image):
+            self._base_image = filename
+            self._source = None
+        else:
+            self._base_image = Image.open(filename)
+            self._source = filename
 
         if self._base_image.mode not in self.__SUPPORTED_MODE:
             raise SteganographyException("Mode not supported")
 
+        self._pixels = None
+        self._rows = None
         self._payloaded_pixel = None
+        self._instrumentation = Instrumentation()
+        self._cache = cache if cache is not None else default_cache
 
     @staticmethod
     def _check_lsb(lsb: int):
         if lsb > 4 or lsb < 1:
             raise SteganographyException("Invalid lsb size")
 
-    @staticmethod
-    def _put_bits(val: int, bit_mask: int, bits: str):
-        if bits == "":
-            return val
-        return val & (~bit_mask) | int(bits, 2)
+    def _get_pixels(self, report=NULL_REPORT) -> np.ndarray:
+        # decoded once, shape (height, width) or (height, width, channels)
+        if self._pixels is None:
+            w, h = self._base_image.size
+            with report.phase("decode", pixels=w * h, allocated_bytes=w * h * self._get_channels()):
+                self._pixels = np.asarray(self._base_image, dtype=np.uint8)
+        return self._pixels
+
+    def add_hook(self, hook):
+        self._instrumentation.add_hook(hook)
+
+    def remove_hook(self, hook):
+        self._instrumentation.remove_hook(hook)
+
+    # collects the report of every embed and extract run inside the block
+    @contextmanager
+    def instrumented(self):
+        reports = []
+        self.add_hook(reports.append)
+        try:
+            yield reports
+        finally:
+            self.remove_hook(reports.append)
+
+    def _get_channels(self) -> int:
+        return len(self._base_image.getbands())
 
     @staticmethod
-    def _roundup(val: int, n: int):
-        return val if val % n == 0 else val + n - val % n
+    def _header(filename: str, length: int) -> bytes:
+        return pack("HHI", Steganography.MAGIC, len(filename), length) + filename.encode("latin-1")
+
+    def _get_permutation(self, key: str, layout: int) -> Permutation:
+        pixels_count = self._base_image.width * self._base_image.height
+        try:
+            return self._cache.get(layout, key, pixels_count)
+        except ValueError:
+            raise SteganographyException("Invalid layout")
 
     def get_payload_size(self, lsb: int) -> int:
         self._check_lsb(lsb)
 
+        # from the image header only, the pixels are not decoded
         pixels_count = self._base_image.width * self._base_image.height
-
-        if type(self._base_image.getdata()[0]) == tuple:
-            return (pixels_count * lsb * len(self._base_image.getdata()[0])) // 8
-
-        return (pixels_count * lsb) // 8
+        return (pixels_count * lsb * self._get_channels()) // 8
 
     def get_stego_image(self) -> Image:
         if self._payloaded_pixel is None:
             return None
 
-        img = Image.new(self._base_image.mode, self._base_image.size)
-        img.putdata(self._payloaded_pixel)
+        with self._instrumentation.operation("rebuild", allocated_bytes=self._payloaded_pixel.nbytes):
+            img = Image.frombytes(self._base_image.mode, self._base_image.size, self._payloaded_pixel.tobytes())
 
-        if img.mode == "P":
-            img.putpalette(self._base_image.getpalette())
+            if img.mode == "P":
+                img.putpalette(self._base_image.getpalette())
         return img
 
     def get_base_image(self) -> Image:
         return self._base_image
 
-    def set_stego_payload(self, filename: str, payload: bytes, key: str, lsb: int):
-        max_payload = self.get_payload_size(lsb) - 8 - len(filename.encode("latin-1"))
-
-        if len(payload) > max_payload:
-            raise SteganographyException("Payload too big")
-
-        if key != "":
-            vigenere = Vigenere(Vigenere.EXTENDED, key=key.encode("utf-8"))
-            payload = vigenere.encrypt(payload)
-            random.seed(sum([ord(key[i]) for i in range(0, len(key), 2)]))
+    def _close_rows(self):
+        if self._rows:
+            self._rows.close()
+        self._rows = None
+
+    # Closes the files opened for a cover given by path, the row reader of a
+    # sequential read and the image itself when it was never decoded
+    def close(self):
+        self._close_rows()
+        if self._source is not None:
+            self._base_image.close()
+
+    # A Steganography for image, a path, an Image or an instance. What it
+    # opened is closed on exit, an instance passed in only drops its row
+    # reader.
+    @staticmethod
+    @contextmanager
+    def _opened(image):
+        if isinstance(image, Steganography):
+            try:
+                yield image
+            finally:
+                image._close_rows()
         else:
-            random.seed(key)
-
-        pixels_count = self._base_image.width * self._base_image.height
-        seq = [i for i in range(pixels_count)]
-        random.shuffle(seq)
-
-        full_payload = pack("HHI", 0x1337, len(filename), len(payload))
-        full_payload += filename.encode("latin-1")
-        full_payload += payload
-        full_payload = BitArray(bytes=full_payload).bin
-        len_payload = self._roundup(len(full_payload), lsb)
-        full_payload = full_payload.ljust(len_payload, '0')
-
-        i = 0
-        bit_mask = (1 << lsb) - 1
-
-        # make copy list pixel
-        self._payloaded_pixel = list(self._base_image.getdata()).copy()
-
-        for pos in seq:
-            if i >= len(full_payload) / lsb:
-                break
-
-            temp_pixel = self._payloaded_pixel[pos]
-
-            if type(temp_pixel) == tuple:
-                list_pixel = []
-                for j in range(len(temp_pixel)):
-                    temp_each_pixel = temp_pixel[j]
-                    temp_each_pixel = self._put_bits(temp_each_pixel, bit_mask, full_payload[lsb*i:lsb*(i+1)])
-                    list_pixel.append(temp_each_pixel)
-                    i += 1
-                temp_pixel = tuple(list_pixel)
-            else:
-                temp_pixel = self._put_bits(temp_pixel, bit_mask, full_payload[lsb*i:lsb*(i+1)])
-                i += 1
+            with Steganography(image) as s:
+                yield s
 
-            self._payloaded_pixel[pos] = temp_pixel
+    def __enter__(self):
+        return self
 
-    def get_stego_payload(self, key: str, lsb: int):
-        pixel_data = list(self._base_image.getdata())
-        bin_payload = ""
+    def __exit__(self, *exc):
+        self.close()
 
-        if key != "":
-            random.seed(sum([ord(key[i]) for i in range(0, len(key), 2)]))
-        else:
-            random.seed(key)
-
-        pixels_count = self._base_image.width * self._base_image.height
-        seq = [i for i in range(pixels_count)]
-        random.shuffle(seq)
+    @staticmethod
+    def _versioned_header(filename: str, length: int, method: int) -> bytes:
+        return (
+            pack("HHI", Steganography.VERSIONED_MAGIC, len(filename), length)
+            + pack("BB", Steganography.VERSION, method)
+            + filename.encode("latin-1")
+        )
+
+    # compression is a Compression method, the payload is compressed before
+    # it is encrypted. Without it the original header is written.
+    def set_stego_payload(self, filename: str, payload: bytes, key: str, lsb: int,
+                          layout: int = Permutation.LEGACY, track_changes: bool = False,
+                          compression: int = None):
+        header, payload = self._prepare_payload(filename, payload, compression)
+        return self._embed(header, payload, key, lsb, layout, track_changes)
+
+    # (header, payload to store), the payload compressed when asked for
+    @staticmethod
+    def _prepare_payload(filename: str, payload: bytes, compression: int = None):
+        if compression is None:
+            return Steganography._header(filename, len(payload)), payload
+
+        try:
+            method, payload = Compression.compress(payload, compression)
+        except CompressionException as e:
+            raise SteganographyException(str(e))
+        return Steganography._versioned_header(filename, len(payload), method), payload
+
+    # header is stored as given, payload is encrypted with the key
+    def _embed(self, header: bytes, payload: bytes, key: str, lsb: int,
+               layout: int = Permutation.LEGACY, track_changes: bool = False):
+        if len(header) + len(payload) > self.get_payload_size(lsb):
+            raise SteganographyException("Payload too big")
 
-        for pos in seq:
-            if len(bin_payload) >= 64:
-                break
-            temp_pixel = pixel_data[pos]
+        with self._instrumentation.operation("embed", lsb=lsb, payload_bytes=len(payload)) as report:
+            seq = self._get_permutation(key, layout)
+
+            # the content is encrypted and embedded chunk by chunk, so no full
+            # copy of the ciphertext is held next to the plaintext
+            content = (
+                memoryview(payload)[i:i + self._CHUNK_SIZE]
+                for i in range(0, len(payload), self._CHUNK_SIZE)
+            )
+            if key != "":
+                vigenere = Vigenere(Vigenere.EXTENDED, key=key.encode("utf-8"))
+                content = report.timed("encrypt", vigenere.encryptor().stream(content))
+
+            flat = self._embed_target(report)
+            changes = [] if track_changes else None
+            self._write_payload(flat, seq, lsb, chain([header], content), changes, report)
+
+        if track_changes:
+            positions = np.concatenate([np.zeros(0, dtype=np.int64)] + [p for p, _ in changes])
+            old = np.concatenate([np.zeros(0, dtype=np.uint8)] + [o for _, o in changes])
+            return ChangeSet(self._base_image, positions, old, flat[positions])
+
+    # Channel values in pixel order, one per symbol position, that the
+    # payload is written to and read from
+    def _embed_target(self, report=NULL_REPORT):
+        pixels = self._get_pixels(report)
+        with report.phase("copy", allocated_bytes=pixels.nbytes):
+            self._payloaded_pixel = pixels.copy()
+        return self._payloaded_pixel.reshape(-1)
+
+    # needed is how many leading values a read uses, None when it can use
+    # any of them. When only a short prefix is needed, a PNG opened from a
+    # path is decoded row by row as far as that; a longer one saves little
+    # over decoding the whole image at once.
+    def _values(self, report=NULL_REPORT, needed: int = None):
+        if needed is not None and needed <= self._STREAM_VALUES and self._pixels is None:
+            if self._rows is None:
+                self._rows = self._open_rows() or False
+            if self._rows:
+                return self._rows
+        self._close_rows()
+        return self._get_pixels(report).reshape(-1)
+
+    def _open_rows(self) -> RowValues:
+        if self._base_image.format != "PNG" or not isinstance(self._source, (str, os.PathLike)):
+            return None
+        f = open(self._source, "rb")
+        try:
+            return RowValues(PngRowReader(f))
+        except PngException:
+            f.close()
+            return None
 
-            if type(temp_pixel) == tuple:
-                for j in range(len(temp_pixel)):
-                    bin_payload += BitArray(int=temp_pixel[j], length=9).bin[-lsb:]
+    def _write_payload(self, flat: np.ndarray, seq, lsb: int, chunks, changes: list = None,
+                       report=NULL_REPORT):
+        channels = self._get_channels()
+        written = 0
+        pending = b""
+
+        # a chunk can only start on a symbol boundary, so bytes that do not
+        # fill whole symbols are carried over to the next chunk
+        for chunk in chain(chunks, [None]):
+            if chunk is None:
+                data = pending
             else:
-                bin_payload += BitArray(int=temp_pixel, length=9).bin[-lsb:]
-
-        bin_payload = bin_payload[:64]
+                data = pending + bytes(chunk)
+                usable = len(data) // lsb * lsb
+                data, pending = data[:usable], data[usable:]
+
+            start = written * 8 // lsb
+            with report.phase("pack", bytes=len(data)):
+                symbols = bytes_to_symbols(data, lsb)
+            with report.phase("permutation", symbols=len(symbols)):
+                positions = channel_positions(seq, channels, start, start + len(symbols))
+            if changes is not None:
+                changes.append((positions, flat[positions]))
+            with report.phase("write", symbols=len(symbols)):
+                embed_symbols(flat, positions, symbols, lsb)
+            written += len(data)
+
+    # length bytes of the stream from byte start on, fewer when the image
+    # ends first. Only the symbols holding them are gathered.
+    def _read_bytes(self, seq, lsb: int, start: int, length: int, report=NULL_REPORT) -> bytes:
+        first = start * 8 // lsb
+        stop = symbol_count(start + length, lsb)
+        # sequential positions are the symbol indices themselves
+        flat = self._values(report, stop if seq.sequential else None)
+        stop = min(stop, flat.size)
+        with report.phase("permutation", symbols=max(0, stop - first)):
+            positions = channel_positions(seq, self._get_channels(), first, stop)
+        with report.phase("gather", symbols=len(positions)):
+            symbols = gather_symbols(flat, positions, lsb)
+        with report.phase("unpack", bytes=length):
+            return symbols_to_bytes(symbols, lsb, start * 8 - first * lsb)[:length]
+
+    # (magic, filename size, content size), None when the image is too small
+    def _read_header(self, seq, lsb: int, report=NULL_REPORT):
+        header = self._read_bytes(seq, lsb, 0, 8, report)
+        if len(header) < 8:
+            return None
+        return unpack("HHI", header)
 
-        payload = BitArray(bin=bin_payload).bytes
-        header, len_filename, len_content = unpack("HHI", payload[:8])
+    def get_stego_payload(self, key: str, lsb: int, layout: int = Permutation.LEGACY):
+        self._check_lsb(lsb)
 
-        if header != 0x1337:
+        with self._instrumentation.operation("extract", lsb=lsb) as report:
+            seq = self._get_permutation(key, layout)
+            try:
+                return self._parse_payload(
+                    lambda start, length: self._read_bytes(seq, lsb, start, length, report), key, report
+                )
+            finally:
+                # an early stopped row reader would keep the file open
+                self._close_rows()
+
+    # read(start, length) gives bytes of the embedded stream, fewer when the
+    # image ends first. Returns (filename, content) or (None, None).
+    @staticmethod
+    def _parse_payload(read, key: str, report=NULL_REPORT):
+        # read only the header first so images without payload are rejected
+        # before gathering the body
+        header = read(0, 8)
+        if len(header) < 8:
             return None, None
 
-        bin_payload = ""
-        for pos in seq:
-            if len(bin_payload) >= (len_content + len_filename + 8) * 8:
-                break
-            temp_pixel = pixel_data[pos]
-
-            if type(temp_pixel) == tuple:
-                for j in range(len(temp_pixel)):
-                    bin_payload += BitArray(int=temp_pixel[j], length=9).bin[-lsb:]
-            else:
-                bin_payload += BitArray(int=temp_pixel, length=9).bin[-lsb:]
+        magic, len_filename, len_content = unpack("HHI", header)
+        if magic == Steganography.MAGIC:
+            start, method = 8, None
+        elif magic == Steganography.VERSIONED_MAGIC:
+            version = read(8, 2)
+            if len(version) < 2:
+                return None, None
+            version, method = unpack("BB", version)
+            if version != Steganography.VERSION:
+                raise SteganographyException("Unsupported payload version")
+            start = 10
+        else:
+            return None, None
 
-        bin_payload = bin_payload[:len(bin_payload) // 8 * 8]
-        payload = BitArray(bin=bin_payload).bytes
-        filename = payload[8:8+len_filename]
-        content = payload[8+len_filename:8+len_filename+len_content]
+        payload = read(start, len_filename + len_content)
+        filename = payload[:len_filename]
+        content = payload[len_filename:len_filename + len_content]
 
         if key != "":
             vigenere = Vigenere(Vigenere.EXTENDED, key=key.encode("utf-8"))
-            content = vigenere.decrypt(content)
+            with report.phase("decrypt", bytes=len(content)):
+                content = vigenere.decrypt(content)
+
+        if method is not None:
+            with report.phase("decompress", bytes=len(content)):
+                try:
+                    content = Compression.decompress(content, method)
+                except CompressionException as e:
+                    raise SteganographyException(str(e))
 
         return filename, content
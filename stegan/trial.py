@@ -0,0 +1,93 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .engine import symbol_count
+from .permutation import KeyedPermutation, Permutation, PermutationCache
+from .steganography import Steganography, SteganographyException
+
+# the 8 byte header takes 64 symbols at lsb 1, fewer at higher lsb
+_HEADER_SYMBOLS = 64
+# same layout as pack("HHI", ...) in Steganography
+_HEADER_DTYPE = np.dtype([("magic", "=u2"), ("len_filename", "=u2"), ("len_content", "=u4")])
+
+
+def _header_pixels(layout: int, key: str, count: int, channels: int) -> np.ndarray:
+    seq = Permutation.create(layout, key, count)
+    return np.asarray(seq[:-(-_HEADER_SYMBOLS // channels)], dtype=np.int64)
+
+
+def _decode_headers(values: np.ndarray, lsb: int) -> np.ndarray:
+    shifts = np.arange(lsb - 1, -1, -1, dtype=np.uint8)
+    bits = ((values[:, :, None] >> shifts) & 1).reshape(len(values), -1)[:, :64]
+    return np.ascontiguousarray(np.packbits(bits, axis=1)).view(_HEADER_DTYPE)[:, 0]
+
+
+# Checks the payload header of an image against many (key, lsb) guesses and
+# returns (key, lsb, filename size, content size) for every guess whose
+# header has the magic and sizes that fit the image.
+#
+# Only the pixel order depends on the key, and legacy keys with the same
+# seed share it, so it is built once per distinct order. The legacy shuffle
+# is pure Python, so it runs in worker processes that send back just the
+# few header pixel indices; keyed orders are computed for all keys in one
+# vectorized pass. The cover is decoded once, here, and all headers are
+# gathered and checked together.
+def find_candidates(image, keys, lsbs=(1, 2, 3, 4), layout: int = Permutation.LEGACY, workers: int = None):
+    # with the sequential layout every key gives the same order, so any
+    # guess would match
+    if layout == Permutation.SEQUENTIAL:
+        raise SteganographyException("The sequential layout does not depend on the key")
+
+    s = image if isinstance(image, Steganography) else Steganography(image)
+    for lsb in lsbs:
+        s._check_lsb(lsb)
+
+    flat = s._get_pixels().reshape(-1)
+    channels = s._get_channels()
+    pixels_count = s.get_base_image().width * s.get_base_image().height
+    header_pixels = min(-(-_HEADER_SYMBOLS // channels), pixels_count)
+
+    groups = {}
+    for key in keys:
+        groups.setdefault(PermutationCache._cache_key(layout, key, pixels_count), []).append(key)
+    groups = list(groups.values())
+    representatives = [group[0] for group in groups]
+
+    if layout == Permutation.KEYED:
+        pixels = KeyedPermutation.lookup_many(representatives, pixels_count, np.arange(header_pixels))
+    elif workers != 1 and len(representatives) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pixels = list(executor.map(
+                _header_pixels,
+                [layout] * len(representatives),
+                representatives,
+                [pixels_count] * len(representatives),
+                [channels] * len(representatives)
+            ))
+    else:
+        pixels = [np.asarray(s._get_permutation(key, layout)[:header_pixels]) for key in representatives]
+
+    pixels = np.asarray(pixels, dtype=np.int64).reshape(len(groups), header_pixels)
+    positions = (pixels[:, :, None] * channels + np.arange(channels)).reshape(len(groups), -1)
+    values = flat[positions[:, :_HEADER_SYMBOLS]]
+
+    matches = []
+    for lsb in lsbs:
+        needed = symbol_count(8, lsb)
+        if needed > values.shape[1]:
+            continue
+
+        headers = _decode_headers(values[:, :needed] & ((1 << lsb) - 1), lsb)
+        versioned = headers["magic"] == Steganography.VERSIONED_MAGIC
+        sizes = 8 + 2 * versioned + headers["len_filename"].astype(np.int64) + headers["len_content"]
+        found = ((headers["magic"] == Steganography.MAGIC) | versioned) & (sizes <= s.get_payload_size(lsb))
+
+        for i in np.flatnonzero(found):
+            header = headers[i]
+            matches.extend(
+                (key, lsb, int(header["len_filename"]), int(header["len_content"]))
+                for key in groups[i]
+            )
+
+    return matches
@@ -1,4 +1,16 @@
+import codecs
+import locale
+import mmap
+import os
 import random
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(1 << 13)], dtype=np.int64)
 
 
 class CryptoException(Exception):
@@ -14,46 +26,71 @@ class Vigenere:
     _DEFAULT_CHARSET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
     _DEFAULT_N = 26
 
+    # Keyed latin square for the FULL variant, filled most constrained cell
+    # first with backtracking, the same search as
     # https://stackoverflow.com/questions/43656104/creation-of-nxn-matrix-sudoku-like
+    # The candidates of a cell are shuffled by random seeded with the key
+    # right before use, so the order only depends on how many there are
+    # and is computed once per count. Tables are cached per key together
+    # with the inverse rows used for decryption.
     @staticmethod
-    def bitcount(n):
-        i = 0
-        while n:
-            i += 1
-            n &= n - 1
-        return i
-
-    def complete(self, rowset, colset, entries):
-        random.seed(self._key)
-        n_size = self._DEFAULT_N
-        if entries == n_size * n_size:
-            return True
-        i, j = max(
-            ((i, j) for i in range(n_size) for j in range(n_size) if self._s_box[i][j] == 0),
-            key=lambda item: (
-                self.bitcount(rowset[item[0]] | colset[item[1]])
-            )
-        )
-
-        bits = rowset[i] | colset[j]
-        p = [n for n in range(1, n_size + 1) if not (bits >> (n - 1)) & 1]
-        random.shuffle(p)
+    @lru_cache(maxsize=256)
+    def _full_tables(key: str):
+        n_size = Vigenere._DEFAULT_N
+        orders = {}
+        for count in range(n_size + 1):
+            orders[count] = list(range(count))
+            random.Random(key).shuffle(orders[count])
+
+        s_box = np.zeros((n_size, n_size), dtype=np.int64)
+        rowset = np.zeros(n_size, dtype=np.int64)
+        colset = np.zeros(n_size, dtype=np.int64)
+
+        def next_cell():
+            used = rowset[:, None] | colset[None, :]
+            constraints = _POPCOUNT[used & 0x1FFF] + _POPCOUNT[used >> 13]
+            constraints[s_box != 0] = -1
+            i, j = divmod(int(np.argmax(constraints)), n_size)
+
+            bits = int(rowset[i] | colset[j])
+            p = [n for n in range(1, n_size + 1) if not (bits >> (n - 1)) & 1]
+            return [i, j, [p[k] for k in orders[len(p)]], 0]
+
+        entries = 0
+        stack = []
+        frame = next_cell()
+        while True:
+            i, j, candidates, tried = frame
+            if tried > 0:
+                n = candidates[tried - 1]
+                s_box[i][j] = 0
+                rowset[i] &= ~(1 << (n - 1))
+                colset[j] &= ~(1 << (n - 1))
+                entries -= 1
+
+            if tried == len(candidates):
+                frame = stack.pop()
+                continue
 
-        for n in p:
-            self._s_box[i][j] = n
+            n = candidates[tried]
+            s_box[i][j] = n
             rowset[i] |= 1 << (n - 1)
             colset[j] |= 1 << (n - 1)
-            if self.complete(rowset, colset, entries + 1):
-                return True
-            rowset[i] &= ~(1 << (n - 1))
-            colset[j] &= ~(1 << (n - 1))
-
-        self._s_box[i][j] = 0
-        return False
-
-    def _load_key(self):
-        key = open(self._filename, "r").read()
-        return ''.join(filter(str.isalpha, key.upper()))
+            entries += 1
+            frame[3] = tried + 1
+
+            if entries == n_size * n_size:
+                break
+            stack.append(frame)
+            frame = next_cell()
+
+        # zero based, indexed [key letter, plain letter] and
+        # [key letter, cipher letter]
+        s_box -= 1
+        inverse = np.argsort(s_box, axis=1)
+        s_box.flags.writeable = False
+        inverse.flags.writeable = False
+        return s_box, inverse
 
     def __init__(self, variant, key=None, filename=None):
         if (variant < 1) and (variant > 5):
@@ -78,222 +115,326 @@ class Vigenere:
                 self._key = ''.join(filter(str.isalpha, key.upper()))
 
             if self._type == Vigenere.FULL:
-                self._s_box = [[0] * self._DEFAULT_N for _ in range(self._DEFAULT_N)]
-                assert self.complete([0] * self._DEFAULT_N, [0] * self._DEFAULT_N, 0)
-
-    def _encrypt_standard(self, plaintext: str):
-        ct = ""
-        idx_key = 0
-
-        for c in plaintext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                ct += c
-                continue
-
-            k = Vigenere._DEFAULT_CHARSET.index(self._key[idx_key])
-            c = Vigenere._DEFAULT_CHARSET.index(c)
-            ct += Vigenere._DEFAULT_CHARSET[(c + k) % 26]
-            idx_key += 1
-            idx_key %= len(self._key)
-
-        return ct
+                self._s_box, self._s_box_inverse = self._full_tables(self._key)
 
-    def _encrypt_full_key(self, plaintext: str):
-        ct = ""
-        idx_key = 0
+    def _new_state(self, offset: int = 0) -> "_KeyState":
+        if offset != 0 and self._type == Vigenere.AUTO_KEY:
+            raise CryptoException("Auto key does not support key offset")
 
-        for c in plaintext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                ct += c
-                continue
+        if self._type == Vigenere.RUNNING_KEY:
+            return _KeyState(RunningKey.load(self._filename), offset)
 
-            k = Vigenere._DEFAULT_CHARSET.index(self._key[idx_key])
-            plain_pos = Vigenere._DEFAULT_CHARSET.index(c)
-            cipher_pos = self._s_box[k][plain_pos] - 1
-            ct += Vigenere._DEFAULT_CHARSET[cipher_pos]
-            idx_key += 1
-            idx_key %= len(self._key)
+        key = self._key
 
-        return ct
+        if self._type != Vigenere.EXTENDED:
+            key = self._code_points(key).astype(np.int64) - ord("A")
+            if np.any((key < 0) | (key >= Vigenere._DEFAULT_N)):
+                raise CryptoException("Invalid key character")
 
-    def _encrypt_auto_key(self, plaintext: str):
-        ct = ""
-        idx_key = 0
-        extend = False
+        return _KeyState(key, offset % len(key) if len(key) else 0)
 
-        for c in plaintext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                ct += c
-                continue
+    @staticmethod
+    def _code_points(text: str) -> np.ndarray:
+        return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+
+    # Runs transform over the positions (0 to 25) of the A-Z letters in text
+    # and puts the results back in place, every other character is kept
+    def _map_letters(self, text: str, state: "_KeyState", transform) -> str:
+        codes = self._code_points(text)
+        letters = np.flatnonzero((codes >= ord("A")) & (codes <= ord("Z")))
+        if len(letters) == 0:
+            return text
+
+        codes = codes.copy()
+        codes[letters] = transform(codes[letters].astype(np.int64) - ord("A"), state) + ord("A")
+        return codes.tobytes().decode("utf-32-le", "surrogatepass")
+
+    # Key positions for the next count letters, repeating the key
+    @staticmethod
+    def _repeat_key(state: "_KeyState", count: int) -> np.ndarray:
+        if isinstance(state.key, RunningKey):
+            keys, state.idx_key = state.key.cycle(state.idx_key, count)
+            return keys
+
+        if len(state.key) == 0:
+            raise CryptoException("Empty key")
+        keys = state.key[(state.idx_key + np.arange(count)) % len(state.key)]
+        state.idx_key = (state.idx_key + count) % len(state.key)
+        return keys
+
+    def _encrypt_standard(self, plaintext: str, state: "_KeyState"):
+        return self._map_letters(
+            plaintext, state,
+            lambda p, state: (p + self._repeat_key(state, len(p))) % Vigenere._DEFAULT_N
+        )
 
-            if not extend:
-                k = Vigenere._DEFAULT_CHARSET.index(self._key[idx_key])
-            else:
-                while plaintext[idx_key] not in Vigenere._DEFAULT_CHARSET:
-                    idx_key += 1
-                k = Vigenere._DEFAULT_CHARSET.index(plaintext[idx_key])
+    def _encrypt_full_key(self, plaintext: str, state: "_KeyState"):
+        return self._map_letters(
+            plaintext, state,
+            lambda p, state: self._s_box[self._repeat_key(state, len(p)), p]
+        )
 
-            c = Vigenere._DEFAULT_CHARSET.index(c)
-            ct += Vigenere._DEFAULT_CHARSET[(c + k) % 26]
+    # After the initial key runs out, the key continues with the plaintext
+    # letters in order. The letters not yet used as key are kept in the
+    # state so the text can be processed in chunks.
+    @staticmethod
+    def _auto_key_known(state: "_KeyState") -> np.ndarray:
+        if len(state.key) == 0:
+            raise CryptoException("Empty key")
+        if state.extend:
+            return state.history
+        return np.concatenate([state.key[state.idx_key:], state.history])
 
-            idx_key += 1
-            if not extend:
-                if idx_key == len(self._key):
-                    extend = True
-                    idx_key = 0
+    @staticmethod
+    def _auto_key_advance(state: "_KeyState", plain: np.ndarray):
+        history = np.concatenate([state.history, plain])
+        if state.extend:
+            state.history = history[len(plain):]
+            return
+
+        remaining = len(state.key) - state.idx_key
+        if len(plain) >= remaining:
+            state.extend = True
+            state.idx_key = 0
+            state.history = history[len(plain) - remaining:]
+        else:
+            state.idx_key += len(plain)
+            state.history = history
 
-        return ct
+    def _encrypt_auto_key(self, plaintext: str, state: "_KeyState"):
+        def transform(p, state):
+            keys = np.concatenate([self._auto_key_known(state), p])[:len(p)]
+            self._auto_key_advance(state, p)
+            return (p + keys) % Vigenere._DEFAULT_N
 
-    def _encrypt_running_key(self, plaintext: str):
-        ct = ""
-        idx_key = 0
-        key = self._load_key()
+        return self._map_letters(plaintext, state, transform)
 
-        for c in plaintext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                ct += c
-                continue
+    def _encrypt_running_key(self, plaintext: str, state: "_KeyState"):
+        return self._encrypt_standard(plaintext, state)
 
-            k = Vigenere._DEFAULT_CHARSET.index(key[idx_key])
-            c = Vigenere._DEFAULT_CHARSET.index(c)
-            ct += Vigenere._DEFAULT_CHARSET[(c + k) % 26]
-            idx_key += 1
-            idx_key %= len(key)
+    # Key bytes tiled into a block of at least _EXTENDED_BLOCK bytes, applied
+    # to the input block by block with wrapping uint8 arithmetic
+    _EXTENDED_BLOCK = 1 << 16
 
-        return ct
+    def _shift_extended(self, data, shift, state: "_KeyState") -> bytes:
+        assert isinstance(self._key, bytes)
 
-    def _encrypt_extended(self, plaintext: bytes):
-        ct = b""
-        idx_key = 0
+        data = np.frombuffer(data, dtype=np.uint8)
+        key = np.roll(np.frombuffer(self._key, dtype=np.uint8), -state.idx_key)
+        key = np.tile(key, max(1, -(-min(len(data), self._EXTENDED_BLOCK) // len(key))))
 
-        assert isinstance(self._key, bytes)
+        result = np.empty(len(data), dtype=np.uint8)
+        for start in range(0, len(data), len(key)):
+            end = min(start + len(key), len(data))
+            shift(data[start:end], key[:end - start], out=result[start:end])
 
-        for c in plaintext:
-            k = self._key[idx_key]
-            ct += bytes([(c + k) % 256])
-            idx_key += 1
-            idx_key %= len(self._key)
+        state.idx_key = (state.idx_key + len(data)) % len(self._key)
+        return result.tobytes()
 
-        return ct
+    def _encrypt_extended(self, plaintext, state: "_KeyState"):
+        return self._shift_extended(plaintext, np.add, state)
 
-    def encrypt(self, plaintext):
+    def _encrypt(self, plaintext, state: "_KeyState"):
         if type(plaintext) == str:
             plaintext = plaintext.upper()
 
         if self._type == Vigenere.STANDARD:
-            return self._encrypt_standard(plaintext)
+            return self._encrypt_standard(plaintext, state)
         elif self._type == Vigenere.FULL:
-            return self._encrypt_full_key(plaintext)
+            return self._encrypt_full_key(plaintext, state)
         elif self._type == Vigenere.AUTO_KEY:
-            return self._encrypt_auto_key(plaintext)
+            return self._encrypt_auto_key(plaintext, state)
         elif self._type == Vigenere.RUNNING_KEY:
-            return self._encrypt_running_key(plaintext)
+            return self._encrypt_running_key(plaintext, state)
         elif self._type == Vigenere.EXTENDED:
-            return self._encrypt_extended(plaintext)
-
-    def _decrypt_standard(self, ciphertext: str):
-        pt = ""
-        idx_key = 0
-
-        for c in ciphertext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                pt += c
-                continue
-
-            k = Vigenere._DEFAULT_CHARSET.index(self._key[idx_key])
-            c = Vigenere._DEFAULT_CHARSET.index(c)
-            pt += Vigenere._DEFAULT_CHARSET[(c - k) % 26]
-            idx_key += 1
-            idx_key %= len(self._key)
-
-        return pt
-
-    def _decrypt_full_key(self, ciphertext: str):
-        pt = ""
-        idx_key = 0
-
-        for c in ciphertext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                pt += c
-                continue
-
-            k = Vigenere._DEFAULT_CHARSET.index(self._key[idx_key])
-            cipher_pos = Vigenere._DEFAULT_CHARSET.index(c)
-            plain_pos = self._s_box[k].index(cipher_pos + 1)
-            pt += Vigenere._DEFAULT_CHARSET[plain_pos]
-            idx_key += 1
-            idx_key %= len(self._key)
-
-        return pt
-
-    def _decrypt_auto_key(self, ciphertext: str):
-        pt = ""
-        idx_key = 0
-        extend = False
-
-        for c in ciphertext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                pt += c
-                continue
-
-            if not extend:
-                k = Vigenere._DEFAULT_CHARSET.index(self._key[idx_key])
-            else:
-                while pt[idx_key] not in Vigenere._DEFAULT_CHARSET:
-                    idx_key += 1
-                k = Vigenere._DEFAULT_CHARSET.index(pt[idx_key])
-
-            c = Vigenere._DEFAULT_CHARSET.index(c)
-            pt += Vigenere._DEFAULT_CHARSET[(c - k) % 26]
+            return self._encrypt_extended(plaintext, state)
 
-            idx_key += 1
-            if not extend:
-                if idx_key == len(self._key):
-                    extend = True
-                    idx_key = 0
+    def encrypt(self, plaintext, offset: int = 0):
+        return self._encrypt(plaintext, self._new_state(offset))
 
-        return pt
-
-    def _decrypt_running_key(self, ciphertext: str):
-        pt = ""
-        idx_key = 0
-        key = self._load_key()
+    def _decrypt_standard(self, ciphertext: str, state: "_KeyState"):
+        return self._map_letters(
+            ciphertext, state,
+            lambda c, state: (c - self._repeat_key(state, len(c))) % Vigenere._DEFAULT_N
+        )
 
-        for c in ciphertext:
-            if c not in Vigenere._DEFAULT_CHARSET:
-                pt += c
-                continue
+    def _decrypt_full_key(self, ciphertext: str, state: "_KeyState"):
+        return self._map_letters(
+            ciphertext, state,
+            lambda c, state: self._s_box_inverse[self._repeat_key(state, len(c)), c]
+        )
 
-            k = Vigenere._DEFAULT_CHARSET.index(key[idx_key])
-            c = Vigenere._DEFAULT_CHARSET.index(c)
-            pt += Vigenere._DEFAULT_CHARSET[(c - k) % 26]
-            idx_key += 1
-            idx_key %= len(key)
+    # Each plaintext letter is keyed by the one a key length earlier, so
+    # with the text in rows of key length p[r] = c[r] - p[r - 1], which
+    # unrolls to an alternating sum down each column
+    def _decrypt_auto_key(self, ciphertext: str, state: "_KeyState"):
+        def transform(c, state):
+            known = self._auto_key_known(state)
+            rows = -(-len(c) // len(known))
 
-        return pt
+            padded = np.zeros(rows * len(known), dtype=np.int64)
+            padded[:len(c)] = c
+            signs = np.where(np.arange(rows) % 2 == 0, 1, -1)[:, None]
+            sums = np.cumsum(padded.reshape(rows, len(known)) * signs, axis=0)
+            p = (signs * (sums - known) % Vigenere._DEFAULT_N).reshape(-1)[:len(c)]
 
-    def _decrypt_extended(self, ciphertext: bytes):
-        pt = b""
-        idx_key = 0
+            self._auto_key_advance(state, p)
+            return p
 
-        assert isinstance(self._key, bytes)
+        return self._map_letters(ciphertext, state, transform)
 
-        for c in ciphertext:
-            k = self._key[idx_key]
-            pt += bytes([(c - k) % 256])
-            idx_key += 1
-            idx_key %= len(self._key)
+    def _decrypt_running_key(self, ciphertext: str, state: "_KeyState"):
+        return self._decrypt_standard(ciphertext, state)
 
-        return pt
+    def _decrypt_extended(self, ciphertext, state: "_KeyState"):
+        return self._shift_extended(ciphertext, np.subtract, state)
 
-    def decrypt(self, ciphertext):
+    def _decrypt(self, ciphertext, state: "_KeyState"):
         if self._type == Vigenere.STANDARD:
-            return self._decrypt_standard(ciphertext)
+            return self._decrypt_standard(ciphertext, state)
         elif self._type == Vigenere.FULL:
-            return self._decrypt_full_key(ciphertext)
+            return self._decrypt_full_key(ciphertext, state)
         elif self._type == Vigenere.AUTO_KEY:
-            return self._decrypt_auto_key(ciphertext)
+            return self._decrypt_auto_key(ciphertext, state)
         elif self._type == Vigenere.RUNNING_KEY:
-            return self._decrypt_running_key(ciphertext)
+            return self._decrypt_running_key(ciphertext, state)
         elif self._type == Vigenere.EXTENDED:
-            return self._decrypt_extended(ciphertext)
+            return self._decrypt_extended(ciphertext, state)
+
+    def decrypt(self, ciphertext, offset: int = 0):
+        return self._decrypt(ciphertext, self._new_state(offset))
+
+    def encryptor(self, offset: int = 0) -> "VigenereStream":
+        return VigenereStream(self._encrypt, self._new_state(offset))
+
+    def decryptor(self, offset: int = 0) -> "VigenereStream":
+        return VigenereStream(self._decrypt, self._new_state(offset))
+
+
+class _KeyState:
+    def __init__(self, key, idx_key: int = 0):
+        self.key = key
+        self.idx_key = idx_key
+        self.extend = False
+        self.history = np.zeros(0, dtype=np.int64)
+
+
+# Letters of a running key file, upper cased with everything but letters
+# dropped, as positions 0 to 25. Small files are read at once; large ones
+# are memory mapped and normalized block by block only as far as the key
+# has been used. Loaded keys are shared and reloaded when the file changes.
+class RunningKey:
+    _BLOCK = 1 << 20
+    _MMAP_SIZE = 16 << 20
+    _CACHE_SIZE = 8
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, filename: str, version: tuple):
+        self.version = version
+        self._lock = threading.Lock()
+        self._letters = np.zeros(0, dtype=np.uint8)
+        self._length = 0
+        self._position = 0
+        self._done = False
+        self._decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+
+        with open(filename, "rb") as f:
+            if version[1] > self._MMAP_SIZE:
+                self._source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._source = f.read()
+
+    @classmethod
+    def load(cls, filename: str) -> "RunningKey":
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with cls._cache_lock:
+            key = cls._cache.get(path)
+            if key is not None and key.version == version:
+                cls._cache.move_to_end(path)
+                return key
+
+        key = cls(path, version)
+        with cls._cache_lock:
+            cls._cache[path] = key
+            cls._cache.move_to_end(path)
+            while len(cls._cache) > cls._CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return key
+
+    @staticmethod
+    def _normalize(text: str) -> np.ndarray:
+        codes = Vigenere._code_points(text.upper())
+        other = np.unique(codes[codes > 0x7F])
+        if any(chr(c).isalpha() for c in other):
+            raise CryptoException("Invalid key character")
+        return (codes[(codes >= ord("A")) & (codes <= ord("Z"))] - ord("A")).astype(np.uint8)
+
+    # Normalizes until at least count letters are known or the file ends
+    def _extend(self, count: int):
+        while self._length < count and not self._done:
+            block = self._source[self._position:self._position + self._BLOCK]
+            self._position += len(block)
+            self._done = self._position >= len(self._source)
+            letters = self._normalize(self._decoder.decode(block, final=self._done))
+
+            if self._length + len(letters) > len(self._letters):
+                grown = np.zeros(max(2 * len(self._letters), self._length + len(letters)), dtype=np.uint8)
+                grown[:self._length] = self._letters[:self._length]
+                self._letters = grown
+            self._letters[self._length:self._length + len(letters)] = letters
+            self._length += len(letters)
+
+        if self._done and isinstance(self._source, mmap.mmap):
+            self._source.close()
+            self._source = b""
+
+    def __len__(self):
+        with self._lock:
+            self._extend(float("inf"))
+            return self._length
+
+    # The count letters from start on, wrapping around at the end of the
+    # key, and the position after them
+    def cycle(self, start: int, count: int):
+        with self._lock:
+            self._extend(start + count)
+            if not self._done or start + count <= self._length:
+                return self._letters[start:start + count].copy(), start + count
+
+            if self._length == 0:
+                raise CryptoException("Empty key")
+            indices = (start + np.arange(count)) % self._length
+            return self._letters[indices], (start + count) % self._length
+
+
+# Keeps the key position between calls, so a text split into chunks
+# encrypts to the same result as the whole text at once
+class VigenereStream:
+    DEFAULT_CHUNK_SIZE = 1 << 16
+
+    def __init__(self, transform, state: _KeyState):
+        self._transform = transform
+        self._state = state
+
+    # Key position reached so far, to continue a long key in a later message
+    @property
+    def offset(self) -> int:
+        return self._state.idx_key
+
+    def update(self, chunk):
+        return self._transform(chunk, self._state)
+
+    def stream(self, source, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        if hasattr(source, "read"):
+            chunk = source.read(chunk_size)
+            while chunk:
+                yield self.update(chunk)
+                chunk = source.read(chunk_size)
+        else:
+            for chunk in source:
+                yield self.update(chunk)